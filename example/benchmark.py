@@ -0,0 +1,321 @@
+# Groundhog processing benchmarks
+import argparse
+import mmap
+import os
+import struct
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pyproj
+
+import ghog
+from ghog.bin import ghog_mkh5
+
+import processor
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Benchmark Groundhog processing")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    mkh5 = sub.add_parser("mkh5", help="Digitizer file trace decoding throughput")
+    mkh5.add_argument("file", help="Groundhog digitizer file (X.ghog)")
+    mkh5.set_defaults(func=bench_mkh5)
+
+    h5 = sub.add_parser("h5", help="HDF5 storage layout size and load throughput")
+    h5.add_argument("file", help="Groundhog HDF5 file")
+    h5.add_argument(
+        "-g", "--group", default="raw", help="Group to load (default = raw)"
+    )
+    h5.add_argument("-r", "--repeat", type=int, default=3, help="Loads per layout")
+    h5.set_defaults(func=bench_h5)
+
+    rstk = sub.add_parser("restack", help="Restack time against trace count")
+    rstk.add_argument(
+        "-n",
+        "--ntrace",
+        type=int,
+        nargs="+",
+        default=[10**3, 10**4, 10**5, 10**6],
+        help="Trace counts (default = 1e3 1e4 1e5 1e6)",
+    )
+    rstk.add_argument("--spt", type=int, default=16, help="Samples per trace")
+    rstk.add_argument(
+        "--interval", type=float, default=1.0, help="Restack interval (m)"
+    )
+    rstk.add_argument(
+        "--legacy",
+        type=int,
+        default=10**4,
+        help="Largest trace count to also time the per-bin mask loop at",
+    )
+    rstk.set_defaults(func=bench_restack)
+
+    flt = sub.add_parser("filt", help="IIR and FFT filter time for typical shapes")
+    flt.add_argument(
+        "-n",
+        "--ntrace",
+        type=int,
+        nargs="+",
+        default=[10**3, 10**4, 3 * 10**4],
+        help="Trace counts (default = 1e3 1e4 3e4)",
+    )
+    flt.add_argument("--spt", type=int, default=512, help="Samples per trace")
+    flt.add_argument(
+        "-w", "--workers", type=int, default=None, help="Threads (default = all CPUs)"
+    )
+    flt.set_defaults(func=bench_filt)
+
+    prec = sub.add_parser(
+        "precision",
+        help="Check float32 processing against float64, error and chain peak memory",
+    )
+    prec.add_argument(
+        "file",
+        nargs="?",
+        default=None,
+        help="Groundhog HDF5 file to run example/processor.py on (default = none)",
+    )
+    prec.add_argument("-n", "--ntrace", type=int, default=3000, help="Synthetic traces")
+    prec.add_argument("--spt", type=int, default=512, help="Samples per trace")
+    prec.set_defaults(func=bench_precision)
+
+    return parser.parse_args()
+
+
+def report(name, seconds, nbytes=None):
+    if nbytes is None:
+        print("%-24s %10.4f s" % (name, seconds))
+    else:
+        print(
+            "%-24s %10.4f s %10.1f MB/s" % (name, seconds, nbytes / seconds / 1e6)
+        )
+
+
+def legacyTraces(data, spt):
+    # Per-trace struct decoding, as done before the vectorized decoder
+    bpt = 8 * spt + 26
+    ntrace = (len(data) - 8) // bpt
+    rx = np.zeros((spt, ntrace), dtype=np.int64)
+    times = []
+
+    data = data[4:]
+    for i in range(ntrace):
+        times.append(np.datetime64(data[i * bpt : i * bpt + 26].decode("utf-8")))
+        rx[:, i] = struct.unpack("q" * spt, data[i * bpt + 26 : (i + 1) * bpt])
+
+    return rx, times
+
+
+def bench_mkh5(args):
+    with open(args.file, "rb") as fd:
+        data = fd.read()
+    header = ghog_mkh5.parseHeader(data, args.file)
+
+    t0 = time.perf_counter()
+    rx_old, t_old = legacyTraces(data[46:], header["spt"])
+    report("struct loop", time.perf_counter() - t0, len(data))
+
+    with open(args.file, "rb") as fd:
+        buf = memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+    t0 = time.perf_counter()
+    rx_new, t_new = ghog_mkh5.parseTraces(buf[46:], header["spt"], args.file)
+    rx_new = np.ascontiguousarray(rx_new)  # touch every sample
+    report("structured dtype", time.perf_counter() - t0, len(data))
+
+    if not np.array_equal(rx_old, rx_new) or not np.array_equal(t_old, t_new):
+        print("WARNING: decoders disagree")
+
+
+def bench_h5(args):
+    data = ghog.load(args.file, group=args.group)
+    nbytes = data["rx"].nbytes
+
+    print("%-24s %12s %10s %10s" % ("layout", "load", "MB/s", "ratio"))
+    with tempfile.TemporaryDirectory() as tmp:
+        base = None
+        for compression in [None, "lzf", "gzip"]:
+            for compact in [False, True]:
+                name = "%s%s" % (compression or "none", " compact" if compact else "")
+                file = os.path.join(tmp, name.replace(" ", "_") + ".h5")
+                ghog.save(file, data, compression=compression, compact=compact)
+                size = os.path.getsize(file)
+                if base is None:
+                    base = size
+
+                # Best of several loads, files are likely in the page cache
+                best = float("inf")
+                for i in range(args.repeat):
+                    t0 = time.perf_counter()
+                    out = ghog.load(file, group="proc")
+                    best = min(best, time.perf_counter() - t0)
+
+                if not np.array_equal(out["rx"], data["rx"]):
+                    print("WARNING: %s does not round trip" % name)
+
+                print(
+                    "%-24s %10.4f s %10.1f %10.2f"
+                    % (name, best, nbytes / best / 1e6, base / size)
+                )
+
+
+def syntheticProfile(ntrace, spt, step=0.4, seed=0):
+    # Random traces along a northward track with about step meters between traces
+    rng = np.random.default_rng(seed)
+    lat = 63.25 + np.cumsum(rng.uniform(0, 2 * step, ntrace)) / 111e3
+    times = np.datetime64("2024-04-19T00:00:00", "us") + np.arange(ntrace) * 50000
+    return {
+        "rx": rng.standard_normal((spt, ntrace)),
+        "gps": ghog.gps_array(
+            np.full(ntrace, -145.4), lat, np.full(ntrace, 1000.0), times
+        ),
+        "attrs": {
+            "fs": 20e6,
+            "pre_trig": 32,
+            "prf": 1000,
+            "spt": spt,
+            "stack": 100,
+            "trig": 50,
+        },
+    }
+
+
+def legacyRestack(rx, dist, interval):
+    # Per-bin boolean mask over all traces, as done before the single pass restack
+    nrstk = np.ceil(dist[-1] / interval).astype(np.uint32)
+    rx_rstk = np.zeros((rx.shape[0], nrstk), dtype=np.float64)
+    for i in range(nrstk):
+        mask = np.logical_and(dist >= interval * i, dist < interval * (i + 1))
+        rx_rstk[:, i] = np.mean(rx[:, mask], axis=1)
+    return rx_rstk
+
+
+def bench_restack(args):
+    for ntrace in args.ntrace:
+        data = syntheticProfile(ntrace, args.spt)
+
+        t0 = time.perf_counter()
+        out = ghog.restack(data, args.interval)
+        report("restack %d" % ntrace, time.perf_counter() - t0, data["rx"].nbytes)
+
+        if ntrace <= args.legacy:
+            gps = data["gps"]
+            xform = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:4978")
+            x, y, z = xform.transform(gps["lat"], gps["lon"], gps["hgt"])
+            steps = np.sqrt(np.diff(x) ** 2 + np.diff(y) ** 2 + np.diff(z) ** 2)
+            dist = np.append(0, np.cumsum(steps))
+
+            t0 = time.perf_counter()
+            rx_old = legacyRestack(data["rx"], dist, args.interval)
+            report("mask loop %d" % ntrace, time.perf_counter() - t0, data["rx"].nbytes)
+
+            if not np.allclose(rx_old, out["rx"], equal_nan=True):
+                print("WARNING: restacks disagree")
+
+
+def bench_filt(args):
+    # Fast time bandpass of raw traces and slow time bandpass of a restacked profile,
+    # the filters in example/processor.py
+    cases = [
+        ("fast", 0, (0.5e6, 4e6)),
+        ("slow", 1, (1 / 1000, 1 / 200)),
+    ]
+    for ntrace in args.ntrace:
+        data = syntheticProfile(ntrace, args.spt)
+        data["attrs"]["stack_interval"] = 5.0
+
+        for name, axis, passband in cases:
+            nbytes = data["rx"].nbytes
+
+            t0 = time.perf_counter()
+            iir = ghog.filt(data, passband, axis=axis, workers=args.workers)
+            report("iir %s %d" % (name, ntrace), time.perf_counter() - t0, nbytes)
+
+            t0 = time.perf_counter()
+            fft = ghog.filt(
+                data, passband, axis=axis, method="fft", workers=args.workers
+            )
+            report("fft %s %d" % (name, ntrace), time.perf_counter() - t0, nbytes)
+
+            # Edge transients differ, compare beyond two edge extensions from the ends
+            edge = 512
+            if data["rx"].shape[axis] <= 2 * edge:
+                continue
+            inner = [slice(None), slice(None)]
+            inner[axis] = slice(edge, -edge)
+            err = np.max(np.abs(iir["rx"] - fft["rx"])[tuple(inner)])
+            if err > 1e-3 * np.max(np.abs(iir["rx"])):
+                print("WARNING: filters disagree by %.2e" % err)
+
+
+def bench_precision(args):
+    # Each processing function, then the example/processor.py chain, in float32 against
+    # float64. Deviations are relative to the largest float64 sample. Exits with an
+    # error if float32 isn't within tolerance or doesn't take about half the memory.
+    failed = []
+
+    data = syntheticProfile(args.ntrace, args.spt, step=1.0)
+    rstk = ghog.restack(data, 2.5)
+    stages = [
+        ("gain", 1e-5, lambda: ghog.gain(data, 2)),
+        ("mute", 1e-5, lambda: ghog.mute(data, [0, 1, 2])),
+        ("filt iir", 1e-5, lambda: ghog.filt(data, (0.5e6, 4e6))),
+        ("filt fft", 1e-5, lambda: ghog.filt(data, (0.5e6, 4e6), method="fft")),
+        ("nmo", 1e-5, lambda: ghog.nmo(data, 100)),
+        ("restack", 1e-5, lambda: ghog.restack(data, 2.5)),
+        # IIR filters with cutoffs far below nyquist lose the most precision
+        ("filt slow", 2e-4, lambda: ghog.filt(rstk, (1 / 1000, 1 / 200), axis=1)),
+        ("stolt", 1e-5, lambda: ghog.stolt(rstk)),
+    ]
+    for name, tolerance, run in stages:
+        images = {}
+        for dtype in ["float64", "float32"]:
+            ghog.config.dtype = dtype
+            images[dtype] = run()["rx"]
+
+        ref = images["float64"]
+        err = np.nanmax(np.abs(images["float32"] - ref)) / np.nanmax(np.abs(ref))
+        print("%-24s %10.2e %10.0e limit" % (name + " deviation", err, tolerance))
+        if images["float32"].dtype != np.float32 or not err <= tolerance:
+            failed.append(name)
+
+    for inplace in [False, True] if args.file is not None else []:
+        mode = "inplace" if inplace else "copy"
+        images = {}
+        peaks = {}
+        for dtype in ["float64", "float32"]:
+            ghog.config.dtype = dtype
+            ghog.stolt_cache_clear()
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            images[dtype] = processor.process(args.file, inplace)["rx"]
+            seconds = time.perf_counter() - t0
+            peaks[dtype] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(
+                "%-24s %10.4f s %10.1f MB peak"
+                % ("%s %s" % (mode, dtype), seconds, peaks[dtype] / 1e6)
+            )
+
+        ref = images["float64"]
+        err = np.max(np.abs(images["float32"] - ref)) / np.max(np.abs(ref))
+        ratio = peaks["float32"] / peaks["float64"]
+        print("%-24s %10.2e %10.0e limit" % ("%s deviation" % mode, err, 1e-4))
+        print("%-24s %10.2f %10.2f limit" % ("%s memory ratio" % mode, ratio, 0.6))
+        if not err <= 1e-4 or ratio > 0.6:
+            failed.append("%s chain" % mode)
+
+    ghog.config.dtype = "float64"
+    if len(failed) > 0:
+        raise SystemExit("float32 out of tolerance: %s" % ", ".join(failed))
+
+
+def main():
+    args = cli()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
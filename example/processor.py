@@ -7,30 +7,47 @@ import ghog
 def cli():
     parser = argparse.ArgumentParser(description="Process Groundhog GPR data")
     parser.add_argument("files", nargs="+", help="file(s) to convert")
+    parser.add_argument(
+        "-d",
+        "--dtype",
+        choices=["float32", "float64"],
+        default="float64",
+        help="Processing precision, float32 halves memory use (default = float64)",
+    )
 
     return parser.parse_args()
 
 
-def main():
-    args = cli()
-    for file in args.files:
-        # Load
-        data = ghog.load(file)
+def process(file, inplace=True):
+    # Load, raw traces are integers so convert while reading
+    data = ghog.load(file, dtype=ghog.config.dtype)
+
+    # Fast time filter (edges in Hz)
+    data = ghog.filt(data, (0.5e6, 4e6), axis=0, inplace=inplace)
+
+    # NMO
+    data = ghog.nmo(data, 100, inplace=inplace)
 
-        # Fast time filter (edges in Hz)
-        data = ghog.filt(data, (0.5e6, 4e6), axis=0)
+    # Restack
+    data = ghog.restack(data, 5, inplace=inplace)
 
-        # NMO
-        data = ghog.nmo(data, 100)
+    # Slow time filter (edges in wavenumber)
+    data = ghog.filt(data, (1 / 1000, 1 / 200), axis=1, inplace=inplace)
 
-        # Restack
-        data = ghog.restack(data, 5)
+    # Migrate
+    data = ghog.stolt(data, inplace=inplace)
 
-        # Slow time filter (edges in wavenumber)
-        data = ghog.filt(data, (1 / 1000, 1 / 200), axis=1)
+    return data
 
-        # Migrate
-        data = ghog.stolt(data)
+
+def main():
+    args = cli()
+    ghog.config.dtype = args.dtype
+
+    # Files migrated on the same grid reuse its remap table
+    ghog.config.stolt_cache_bytes = 2**28
+    for file in args.files:
+        data = process(file)
 
         # Save
         ghog.save(file, data, group="restack")
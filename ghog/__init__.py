@@ -1,13 +1,25 @@
+from . import config
+
+from .data import GhogData
+
 from .h5io import load
 from .h5io import save
+from .h5io import open
+
+from .gps import gps_array
+from .gps import gps_times
 
 from .nmo import nmo
 
 from .restack import restack
 
 from .filt import filt
+from .filt import filt_stream
 
 from .stolt import stolt
+from .stolt import stolt_scan
+from .stolt import stolt_cache_info
+from .stolt import stolt_cache_clear
 
 from .figure import figure
 
@@ -5,6 +5,9 @@ import h5py
 import pandas as pd
 import matplotlib.pyplot as plt
 
+import ghog.gps
+import ghog.h5io
+
 
 def cli():
     # Command line interface
@@ -55,7 +58,8 @@ def main():
     # Loop over hdf5 files and add solutions from appropriate pos file
     for h5 in hdf5:
         with h5py.File(h5, mode="r+") as fd:
-            h5times = np.array(list(map(np.datetime64, fd["raw/gps0"]["utc"])))
+            gps = fd["raw/gps0"][:]
+            h5times = ghog.gps.gps_times(gps)
             match = None
             for pos in posBounds.keys():
                 bound = posBounds[pos]
@@ -81,26 +85,19 @@ def main():
             lati = np.interp(th5_sse, tppp_sse, df["lat"])
             hgti = np.interp(th5_sse, tppp_sse, df["HGT(m)"])
 
-            ppp_t = np.dtype(
-                [("lon", "f8"), ("lat", "f8"), ("hgt", "f8"), ("utc", "S26")]
+            ppp = ghog.gps.gps_array(
+                loni, lati, hgti, h5times, epoch="epoch" in gps.dtype.names
             )
-            ppp = [None] * len(h5times)
-            for i in range(len(h5times)):
-                ppp[i] = tuple(
-                    [
-                        loni[i],
-                        lati[i],
-                        hgti[i],
-                        h5times[i],
-                    ]
-                )
-            ppp = np.array(ppp, dtype=ppp_t)
 
             raw = fd.require_group("raw")
             ppp0 = raw.require_dataset("ppp0", shape=ppp.shape, dtype=ppp.dtype)
             ppp0[:] = ppp
             ppp0.attrs["desc"] = "CSRS PPP solution"
 
+            # ghog.load reads ppp0 in place of gps0, index it instead
+            ghog.h5io.write_index(raw, ppp, "ppp0")
+            ghog.h5io.write_distance(raw, ppp)
+
 
 if __name__ == "__main__":
     main()
@@ -58,7 +58,8 @@ def main():
                 print("Length 0 or 1 /%s/gps0 dataset in %s" % (args.group, file))
                 continue
 
-            gps = [(lon, lat, elev) for (lon, lat, elev, time) in data["gps"]]
+            gps = data["gps"]
+            gps = list(zip(gps["lon"], gps["lat"], gps["hgt"]))
 
             row["geometry"] = LineString(gps)
             row["fname"] = os.path.basename(file)
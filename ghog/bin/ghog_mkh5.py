@@ -1,16 +1,32 @@
 # Generate Groundhog HDF5 files from raw Groundhog files
 import argparse
 import calendar
+import concurrent.futures
+import contextlib
+import functools
 import glob
+import hashlib
+import io
+import json
+import mmap
 import os
 import struct
 import time
 import traceback
 
 import h5py
-import matplotlib.pyplot as plt
 import numpy as np
 
+import ghog.gps
+import ghog.h5io
+
+BLOCK_TRACES = 4096  # traces per block when writing rx0
+SCAN_BYTES = 2**26  # bytes per block when scanning damaged files for traces
+FOLLOW_POLL = 1.0  # seconds between checks for new traces when following a file
+FOLLOW_HOLD = 10.0  # longest wait in seconds of trace time for GPS when following
+MANIFEST = "ghog_mkh5_manifest.json"  # incremental conversion record in output directory
+FORMAT_VERSION = 1  # HDF5 output layout, outputs of other versions are converted again
+
 
 def cli():
     # Command line interface
@@ -30,6 +46,58 @@ def cli():
         help="Directory to write Groundhog HDF5 files to (default = ./).",
         default=".",
     )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        action="store_true",
+        help="Read and write traces in blocks instead of loading whole files, for files too large to fit in memory.",
+    )
+    parser.add_argument(
+        "-b",
+        "--block",
+        type=int,
+        help="Traces per block in streaming mode (default = %d)." % BLOCK_TRACES,
+        default=BLOCK_TRACES,
+    )
+    parser.add_argument(
+        "-c",
+        "--compression",
+        type=str,
+        choices=["gzip", "lzf"],
+        help="Compress rx0 and gps0, chunked along traces and byte shuffled (default = no compression).",
+        default=None,
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Store samples in the narrowest integer type that holds them. Not available when streaming or following.",
+    )
+    parser.add_argument(
+        "-f",
+        "--follow",
+        action="store_true",
+        help="Convert files while they are being written, appending new traces to HDF5 files that can be read as they grow. Returns once the digitizer closes each file.",
+    )
+    parser.add_argument(
+        "--poll",
+        type=float,
+        help="Seconds between checks for new traces when following (default = %.1f)."
+        % FOLLOW_POLL,
+        default=FOLLOW_POLL,
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Only convert files that are new, have changed, or were converted with other options since they were last converted to the output directory, tracked with a manifest file (%s) there." % MANIFEST,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of files to convert in parallel (default = 1).",
+        default=1,
+    )
     parser.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
     return parser
 
@@ -54,16 +122,79 @@ def parseHeader(data, file):
     return header
 
 
-def parseTraces(data, spt, file):
+def traceDtype(spt):
+    # On-disk layout of one trace, system time string followed by samples
+    return np.dtype([("time", "S26"), ("rx", "<i8", (spt,))])
+
+
+def timeDtype(spt):
+    # Trace layout with the time string as raw bytes, for validating times
+    return np.dtype([("time", "u1", (26,)), ("rx", "<i8", (spt,))])
+
+
+TIME_PATTERN = np.frombuffer(b"0000-00-00T00:00:00.000000", dtype=np.uint8)
+TIME_DIGITS = TIME_PATTERN == ord("0")
+
+
+def validTimes(b):
+    # Rows of b (n x 26 bytes) that are formatted like trace times
+    digits = b[:, TIME_DIGITS]
+    return np.all(b[:, ~TIME_DIGITS] == TIME_PATTERN[~TIME_DIGITS], axis=1) & np.all(
+        (digits >= ord("0")) & (digits <= ord("9")), axis=1
+    )
+
+
+def scanTraces(data, spt, file):
+    # Find complete traces in a damaged data segment by searching for trace time
+    # strings, rather than assuming traces are back to back. Returns a list of
+    # (offset, ntrace) runs of back to back traces.
+    bpt = traceDtype(spt).itemsize
+    u8 = np.frombuffer(data, dtype=np.uint8)
+    end = len(u8) - 4 if data[-4:] == b"\xad\xde\xad\xde" else len(u8)
+    last = end - 26  # last possible trace start
+
+    # Candidate trace starts have the date/time separator 10 bytes in, searched for
+    # in blocks to bound the size of temporaries
+    starts = [np.zeros(0, dtype=np.int64)]
+    for i in range(4, last + 1, SCAN_BYTES):
+        blk = u8[i + 10 : min(i + SCAN_BYTES, last + 1) + 10]
+        starts.append(np.flatnonzero(blk == ord("T")) + i)
+    starts = np.concatenate(starts)
+
+    # Narrow down with the other separators, then check the whole string
+    for j in np.flatnonzero(~TIME_DIGITS):
+        starts = starts[u8[starts + j] == TIME_PATTERN[j]]
+    starts = starts[validTimes(u8[starts[:, np.newaxis] + np.arange(26)])]
+
+    # A trace is complete if the next one starts no sooner than a trace length later
+    keep = starts[np.diff(starts, append=end) >= bpt]
+    runs = np.split(keep, np.flatnonzero(np.diff(keep) != bpt) + 1)
+
+    # Traces whose time string was destroyed aren't among the starts, so the number
+    # dropped is estimated from the bytes lost
+    lost = end - 4 - len(keep) * bpt
+    print(
+        "%s - Recovered %d traces, dropped about %d damaged trace(s) (%d bytes)"
+        % (file, len(keep), round(lost / bpt), lost)
+    )
+
+    return [(int(run[0]), len(run)) for run in runs if len(run) > 0]
+
+
+def findTraces(data, spt, file):
+    # Locate the traces in a data segment. Returns a list of (offset, ntrace) runs of
+    # back to back traces, or None if the segment is malformed. Trace times are
+    # checked and the segment is scanned for intact traces if any are out of place,
+    # as it is if its length isn't a whole number of traces.
     partial = False
-    bpt = 8 * spt + 26  # bytes per trace
+    bpt = traceDtype(spt).itemsize  # bytes per trace
 
     if data[0:4] != b"\xce\xfa\xed\xfe":
         print(
             file,
             "is improperly formed Groundhog digitizer file, missing data segment magic bytes.",
         )
-        return -1, -1
+        return None
 
     if data[-4:] != b"\xad\xde\xad\xde":
         print(
@@ -73,30 +204,87 @@ def parseTraces(data, spt, file):
         print("Will continue attempt to convert")
         partial = True
 
-    ntrace = (len(data) - 8) / bpt
+    if partial:
+        ntrace = (len(data) - 4) / bpt
+    else:
+        ntrace = (len(data) - 8) / bpt
 
-    if ntrace != int(ntrace):
-        if partial:
-            nkeep = int(ntrace) * bpt + 4
-            data = data[:nkeep]
-        else:
-            print("File appears corrupted (some partial traces missing)")
-            print("Need to implement reader for this")
-            return -1, -1
+    if ntrace != int(ntrace) and not partial:
+        print("File appears corrupted (some partial traces missing)")
+        print("Attempting to recover intact traces")
+        return scanTraces(data, spt, file)
+
+    ntrace = max(int(ntrace), 0)
 
-    ntrace = int(ntrace)
-    rx = np.zeros((spt, ntrace), dtype=np.int64)
-    times = []
+    # Only the time strings are read, a block of traces at a time
+    times = np.frombuffer(data, dtype=timeDtype(spt), count=ntrace, offset=4)["time"]
+    for i in range(0, ntrace, BLOCK_TRACES):
+        if not np.all(validTimes(times[i : i + BLOCK_TRACES])):
+            print("%s - Traces out of place, attempting to recover intact traces" % file)
+            return scanTraces(data, spt, file)
 
-    data = data[4:]
-    for i in range(ntrace):
-        times.append(np.datetime64(data[i * bpt : i * bpt + 26].decode("utf-8")))
-        rx[:, i] = struct.unpack("q" * spt, data[i * bpt + 26 : (i + 1) * bpt])
+    return [(4, ntrace)]
+
+
+def parseTraces(data, spt, file):
+    runs = findTraces(data, spt, file)
+
+    if runs is None:
+        return None, None
+
+    # View the data segment as arrays of traces, nothing is copied here. rx is a
+    # strided (spt, ntrace) view into the file buffer unless the file was damaged.
+    traces = [
+        np.frombuffer(data, dtype=traceDtype(spt), count=ntrace, offset=offset)
+        for offset, ntrace in runs
+    ]
+    if len(traces) == 1:
+        traces = traces[0]
+    else:
+        traces = np.concatenate(traces)
+
+    times = traces["time"].astype("datetime64[us]")
+    rx = traces["rx"].T
 
     return rx, times
 
 
-def buildH5(header, rx, gps, file):
+def readTraces(fd, spt, runs, block, base=0):
+    # Generate (rx, times) for blocks of traces read from fd, given (offset, ntrace)
+    # runs of traces with offsets relative to base. The read buffer is reused, so
+    # each block is only valid until the next one is requested.
+    trace_t = traceDtype(spt)
+    buf = memoryview(bytearray(block * trace_t.itemsize))
+
+    for offset, ntrace in runs:
+        fd.seek(base + offset)
+        for i in range(0, ntrace, block):
+            view = buf[: min(block, ntrace - i) * trace_t.itemsize]
+            if fd.readinto(view) != len(view):
+                raise EOFError("Digitizer file ended before trace %d" % i)
+
+            traces = np.frombuffer(view, dtype=trace_t)
+            yield traces["rx"].T, traces["time"].astype("datetime64[us]")
+
+
+@contextlib.contextmanager
+def atomicH5(file):
+    # Write an HDF5 file under a temporary name and rename it once complete, so an
+    # interrupted conversion never leaves a partial file behind
+    tmp = file + ".tmp"
+    fd = h5py.File(tmp, "w")
+    try:
+        yield fd
+    except BaseException:
+        fd.close()
+        os.remove(tmp)
+        raise
+
+    fd.close()
+    os.replace(tmp, file)
+
+
+def buildH5(header, rx, gps, file, compression=None, compact=False):
     try:
         if gps is not None:
             time0 = gps["utc"][0][:19].decode()
@@ -105,18 +293,37 @@ def buildH5(header, rx, gps, file):
         else:
             time0 = "unk"
 
-        fd = h5py.File(file, "w")
+        dtype = ghog.h5io.narrow_dtype(rx) if compact else rx.dtype
+        rx_kw = ghog.h5io.filters(compression)
+        gps_kw = ghog.h5io.filters(compression)
+        if compression is not None:
+            ntrace = ghog.h5io.chunk_traces(rx.shape[0], dtype.itemsize)
+            ntrace = min(rx.shape[1], ntrace)
+            rx_kw["chunks"] = (rx.shape[0], ntrace)
+            gps_kw["chunks"] = (ntrace,)
 
-        raw = fd.create_group("raw")
-        rx0 = raw.create_dataset("rx0", data=rx)
+        with atomicH5(file) as fd:
+            raw = fd.create_group("raw")
+            rx0 = raw.create_dataset("rx0", shape=rx.shape, dtype=dtype, **rx_kw)
 
-        if gps is not None:
-            raw.create_dataset("gps0", data=gps)
+            # Write in blocks of traces so a strided view of the digitizer file is
+            # never copied all at once
+            for i in range(0, rx.shape[1], BLOCK_TRACES):
+                rx0[:, i : i + BLOCK_TRACES] = rx[:, i : i + BLOCK_TRACES].astype(dtype)
+
+            if gps is not None:
+                raw.create_dataset("gps0", data=gps, **gps_kw)
+                ghog.h5io.write_index(raw, gps)
 
-        for k, v in header.items():
-            rx0.attrs[k] = v
+            for k, v in header.items():
+                rx0.attrs[k] = v
 
-        fd.close()
+            if gps is not None:
+                ghog.h5io.write_distance(raw, gps, **gps_kw)
+
+            # ghog.load casts narrowed samples back
+            if dtype != rx.dtype:
+                rx0.attrs["dtype"] = rx.dtype.str
     except Exception as e:
         print("Failure in buildH5")
         print(e)
@@ -125,300 +332,835 @@ def buildH5(header, rx, gps, file):
     return 0
 
 
-def DDMtoDD(ddm):
-    d = np.float64(ddm[:-7])
-    m = np.float64(ddm[-7:]) / 60.0
-    return d + m
+def createH5(fd, header, rx, gps, compression=None):
+    # Resizable raw/rx0 and raw/gps0 datasets for blocks of traces to be appended to,
+    # typed after the first block
+    ntrace = ghog.h5io.chunk_traces(rx.shape[0], rx.dtype.itemsize)
+    raw = fd.create_group("raw")
+    rx0 = raw.create_dataset(
+        "rx0",
+        shape=(rx.shape[0], 0),
+        maxshape=(rx.shape[0], None),
+        chunks=(rx.shape[0], ntrace),
+        dtype=rx.dtype,
+        **ghog.h5io.filters(compression),
+    )
+    for k, v in header.items():
+        rx0.attrs[k] = v
+
+    gps0 = None
+    if gps is not None:
+        gps0 = raw.create_dataset(
+            "gps0",
+            shape=(0,),
+            maxshape=(None,),
+            chunks=(ntrace,),
+            dtype=gps.dtype,
+            **ghog.h5io.filters(compression),
+        )
 
+    return rx0, gps0
 
-def parseGPS(file):
+
+def appendH5(rx0, gps0, rx, gps, flush=False):
+    # Append a block of traces. Positions are written, and with flush made visible to
+    # SWMR readers, before the traces, so readers never see traces without positions.
+    n = rx0.shape[1]
+    if gps0 is not None:
+        gps0.resize(n + len(gps), axis=0)
+        gps0[n:] = gps
+        if flush:
+            gps0.flush()
+
+    rx0.resize(n + rx.shape[1], axis=1)
+    rx0[:, n:] = rx
+    if flush:
+        rx0.flush()
+
+
+def streamH5(header, blocks, fix, file, outfile, compression=None):
     try:
-        nmeas = open(file, mode="r").read().splitlines()
-        nmeas = [nmea.strip("\x00") for nmea in nmeas]
-        nmeas = list(filter(None, nmeas))
+        with contextlib.ExitStack() as stack:
+            fd = None
+            for rx, tTrace in blocks:
+                if fix is not None:
+                    gps = gpsArray(interpFix(tTrace, fix, file, check=False))
+                else:
+                    gps = None
+
+                if fd is None:
+                    fd = stack.enter_context(atomicH5(outfile))
+                    rx0, gps0 = createH5(fd, header, rx, gps, compression)
+                    tFirst = tTrace[0]
+
+                appendH5(rx0, gps0, rx, gps)
+
+            if fd is None:
+                print("No traces to write")
+                return -1
+
+            if fix is not None:
+                checkFix(tFirst, tTrace[-1], fix, file)
+                gps = gps0[:]
+                ghog.h5io.write_index(fd["raw"], gps)
+                ghog.h5io.write_distance(
+                    fd["raw"], gps, **ghog.h5io.filters(compression)
+                )
+
     except Exception as e:
+        print("Failure in streamH5")
         print(e)
-        return (-1, -1)
+        return -1
 
-    # List of tuples (system time, gnss time, lon, lat, hgt)
-    lons = []
-    lats = []
-    hgts = []
-    times = []
-    dates = []
-    for i, nmea in enumerate(nmeas):
-        if "class" in nmea:
-            # skip json info strings
-            continue
+    return 0
 
-        syst, fix = nmea.split(": $", maxsplit=1)
-        syst = np.datetime64(syst)
 
-        if "GGA" in fix:
-            # Parse it
-            fix = fix.split(",")
+def byteStrings(u8, start, stop):
+    # Byte strings u8[start[i]:stop[i]] as an array of NUL padded byte strings
+    width = max(int(np.max(stop - start, initial=0)), 1)
+    idx = start[:, np.newaxis] + np.arange(width)
+    b = u8[np.minimum(idx, len(u8) - 1)]
+    b[idx >= stop[:, np.newaxis]] = 0
+    return b.view("S%d" % width)[:, 0]
 
-            if fix[1] != "":
-                time = (
-                    float(fix[1][:2]) * 60 * 60
-                    + float(fix[1][2:4]) * 60
-                    + float(fix[1][4:8])
-                )
-            times.append((syst, time))
 
-            if fix[2] != "" and fix[4] != "" and fix[9] != "":
-                lat = DDMtoDD(fix[2])
-                lon = DDMtoDD(fix[4])
-                hgt = float(fix[9])
+def strBytes(a, width):
+    # Array of byte strings as an (n, width) array of bytes, NUL padded or truncated
+    return a.astype("S%d" % width).view(np.uint8).reshape(len(a), width)
 
-                if fix[3] == "S":
-                    lat *= -1
 
-                if fix[5] == "W":
-                    lon *= -1
+def strSlice(a, start, stop):
+    # a[start:stop] for each byte string in array a
+    b = strBytes(a, stop)[:, start:]
+    return np.ascontiguousarray(b).view("S%d" % (stop - start))[:, 0]
 
-                lons.append((syst, lon))
-                lats.append((syst, lat))
-                hgts.append((syst, hgt))
 
-            continue
+def DDMtoDD(ddm):
+    # Degrees decimal minutes strings to decimal degrees, the last seven characters
+    # of each string are minutes
+    w = max(ddm.dtype.itemsize, 7)
+    b = strBytes(ddm, w)
+    n = np.sum(b != 0, axis=1)[:, np.newaxis]
+    d = np.where(np.arange(w) < n - 7, b, 0).astype(np.uint8)
+    m = np.take_along_axis(b, n - 7 + np.arange(7), axis=1)
+    d = np.ascontiguousarray(d).view("S%d" % w)[:, 0].astype(np.float64)
+    m = np.ascontiguousarray(m).view("S7")[:, 0].astype(np.float64) / 60.0
+    return d + m
 
-        if "ZDA" in fix:
-            fix = fix.split(",")
-            time = (
-                float(fix[1][:2]) * 60 * 60
-                + float(fix[1][2:4]) * 60
-                + float(fix[1][4:8])
-            )
-            date = np.datetime64(fix[4] + "-" + fix[3] + "-" + fix[2])
 
-            times.append((syst, time))
-            dates.append((syst, date))
+def parseNMEA(text):
+    # Columns of times of day, positions and the first date from gpspipe output.
+    # Times of day and positions come with the system times they were logged at.
+    u8 = np.frombuffer(text.replace(b"\x00", b""), dtype=np.uint8)
 
-            continue
+    # Find the first ": $" separating system time and sentence on each line
+    nl = np.flatnonzero(u8 == ord("\n"))
+    sep = np.flatnonzero(
+        (u8[:-2] == ord(":")) & (u8[1:-1] == ord(" ")) & (u8[2:] == ord("$"))
+    )
+    line = np.searchsorted(nl, sep)
+    first = np.unique(line, return_index=True)[1]
+    sep = sep[first]
+    line = line[first]
+    bol = np.append(-1, nl)[line] + 1
+    eol = np.append(nl, len(u8))[line]
+    eol = eol - (u8[np.maximum(eol - 1, 0)] == ord("\r"))
+
+    # Keep GGA, ZDA and RMC sentences, type follows the two character talker ID
+    kind = byteStrings(u8, np.minimum(sep + 5, eol), np.minimum(sep + 8, eol))
+    keep = np.isin(kind, [b"GGA", b"ZDA", b"RMC"])
+    sep, bol, eol = sep[keep], bol[keep], eol[keep]
+    syst = byteStrings(u8, bol, sep).astype("datetime64[us]")
+
+    # f[i] is NMEA field i of each sentence, empty if missing, and f[0] is the type.
+    # Only the fields used below are extracted.
+    commas = np.append(np.flatnonzero(u8 == ord(",")), len(u8))
+    c0 = np.searchsorted(commas, sep)
+    f = {0: kind[keep]}
+    for i in [1, 2, 3, 4, 5, 9]:
+        start = commas[np.minimum(c0 + i - 1, len(commas) - 1)] + 1
+        stop = np.minimum(commas[np.minimum(c0 + i, len(commas) - 1)], eol)
+        f[i] = byteStrings(u8, start, np.maximum(stop, start))
+
+    gga = f[0] == b"GGA"
+    zda = f[0] == b"ZDA"
+    rmc = f[0] == b"RMC"
+
+    nmea = {}
+
+    # Seconds of day from hhmmss.ss times
+    valid = f[1] != b""
+    nmea["tutc"] = syst[valid]
+    nmea["tod"] = (
+        strSlice(f[1][valid], 0, 2).astype(np.float64) * 60 * 60
+        + strSlice(f[1][valid], 2, 4).astype(np.float64) * 60
+        + strSlice(f[1][valid], 4, 8).astype(np.float64)
+    )
 
-        if "RMC" in fix:
-            fix = fix.split(",")
+    # Positions from GGA
+    valid = gga & (f[2] != b"") & (f[4] != b"") & (f[9] != b"")
+    nmea["tloc"] = syst[valid]
+    nmea["lats"] = DDMtoDD(f[2][valid])
+    nmea["lons"] = DDMtoDD(f[4][valid])
+    nmea["hgts"] = f[9][valid].astype(np.float64)
+    nmea["lats"][f[3][valid] == b"S"] *= -1
+    nmea["lons"][f[5][valid] == b"W"] *= -1
+
+    # Date from the first ZDA or RMC sentence
+    dated = np.flatnonzero(zda | (rmc & (f[9] != b"")))
+    nmea["date"] = np.datetime64("NaT", "D")
+    if len(dated) > 0:
+        i = dated[0]
+        if zda[i]:
+            date = b"-".join([f[4][i], f[3][i], f[2][i]]).decode()
+        else:
+            ddmmyy = f[9][i].decode()
+            date = "20" + ddmmyy[4:6] + "-" + ddmmyy[2:4] + "-" + ddmmyy[0:2]
+        nmea["date"] = np.datetime64(date, "D")
 
-            if fix[1] != "":
-                time = (
-                    float(fix[1][:2]) * 60 * 60
-                    + float(fix[1][2:4]) * 60
-                    + float(fix[1][4:8])
-                )
-                times.append((syst, time))
+    return nmea
 
-            if fix[9] != "":
-                date = np.datetime64(
-                    "20" + fix[9][4:6] + "-" + fix[9][2:4] + "-" + fix[9][0:2]
-                )
-                dates.append((syst, date))
 
-            continue
+def appendNMEA(nmea, more):
+    # Concatenate columns parsed from consecutive pieces of gpspipe output
+    out = {k: np.append(nmea[k], more[k]) for k in nmea if k != "date"}
+    out["date"] = more["date"] if np.isnat(nmea["date"]) else nmea["date"]
+    return out
 
-    if times == [] and lats == [] and lons == [] and hgts == []:
+
+def stitchGPS(nmea):
+    # Fix from parsed NMEA columns, GNSS times of day stitched to the date
+    if len(nmea["tod"]) == 0:
         # Bail if no GPS info
         print("No gps information found")
         return (-1, -1)
 
+    if np.isnat(nmea["date"]):
+        print("No date information found")
+        return (-1, -1)
+
     # Handle day rollover if necessary
-    tsyst, tgps = zip(*times)
-    tgps = list(tgps)
-    if np.sum(np.diff(tgps) < 0):
-        # Get system time of rollover
-        roll = np.where(np.diff(tgps) < 0)[0][0] + 1
-        for i in range(roll, len(tgps)):
-            tgps[i] += 86400
+    tgps = np.copy(nmea["tod"])
+    roll = np.flatnonzero(np.diff(tgps) < 0)
+    if len(roll) > 0:
+        tgps[roll[0] + 1 :] += 86400
 
     # Stitch dates and times
-    _, dates = zip(*dates)
-    dates = list(dates)
-    cmt = """
+    times = nmea["date"] + (tgps * 1e3).astype(np.int64).astype("timedelta64[ms]")
+
+    fix = {k: nmea[k] for k in ["tloc", "lons", "lats", "hgts", "tutc"]}
+    fix["times"] = times
+
+    # Fill in location values if empty
+    if len(fix["tloc"]) == 0:
+        print("No location values from gps")
+        fix["tloc"] = fix["tutc"]
+        fix["lons"] = np.zeros(len(times))
+        fix["lats"] = np.zeros(len(times))
+        fix["hgts"] = np.zeros(len(times))
+
+    # Positions and times each come with the system times they were logged at
+    return fix
+
+
+def parseGPS(file):
     try:
-        _, dates = zip(*dates)
-        dates = list(dates)
-    except ValueError:
-        # Handling weird gulkana data - should move this to oneoff
-        fid = int(file[-8:-4])
-        if fid < 57:
-            print("Missing date information. Hardcoding to 2024-04-19")
-            dates = [np.datetime64("2024-04-19")]
-        else:
-            print("Missing date information. Hardcoding to 2024-04-20")
-            dates = [np.datetime64("2024-04-20")]
+        with open(file, mode="rb") as fd:
+            text = fd.read()
+    except Exception as e:
+        print(e)
+        return (-1, -1)
 
-    # Handling other ruth issue - should move this to oneoff somehow
-    if dates[0] > np.datetime64("2039"):
-        print("Bad GPS week, removing 1024 weeks")
-        dates[0] -= np.timedelta64(1024, "W")
-    """
+    return stitchGPS(parseNMEA(text))
 
-    for i in range(len(tgps)):
-        tgps[i] = dates[0] + np.timedelta64(int(tgps[i] * 1e3), "ms")
 
-    times = list(zip(tsyst, tuple(tgps)))
+def checkFix(tFirst, tLast, fix, file):
+    # Warn if GPS times do not span the trace times
+    for tFix in (fix["tloc"], fix["tutc"]):
+        if tFix[0] > tFirst or tFix[-1] < tLast:
+            print("%s - GPS times do not entirely contain data file times" % file)
+            return
 
-    # Fill in location values if empty
-    if lons == [] and lats == [] and hgts == []:
-        print("No location values from gps")
-        lons = list(zip(tsyst, np.zeros(len(tsyst))))
-        lats = list(zip(tsyst, np.zeros(len(tsyst))))
-        hgts = list(zip(tsyst, np.zeros(len(tsyst))))
 
-    return {"lons": lons, "lats": lats, "hgts": hgts, "times": times}
+def interpFix(tTrace, fix, file, check=True):
+    # Interpolate GPS fix to trace times. Everything is converted once to seconds
+    # since the first GPS time, shared by all channels.
+
+    if check:
+        checkFix(tTrace[0], tTrace[-1], fix, file)
+
+    epoch = fix["tutc"][0]
 
+    def sse(t):
+        return ((t - epoch).astype("timedelta64[us]")).astype(np.float64) / 1e6
 
-def interpFix(tTrace, fix, file):
-    # Interpolate GPS fix to trace times
+    tTrace_sse = sse(tTrace)
+    tLoc_sse = sse(fix["tloc"])
 
     traceFix = {}
-    warn = 0
-    for k, v in fix.items():
-        tFix, vals = zip(*v)
-        epoch = tFix[0]
-        if (tFix[0] > tTrace[0] or tFix[-1] < tTrace[-1]) and not warn:
-            print("%s - GPS times do not entirely contain data file times" % file)
-            warn = 1
-
-        tTrace_sse = ((tTrace - epoch).astype("timedelta64[us]")).astype(
-            np.float64
-        ) / 1e6
-        tFix_sse = ((tFix - epoch).astype("timedelta64[us]")).astype(np.float64) / 1e6
-
-        if k == "times":
-            # I think this will break if the file covers a leap second
-            tUtc_sse = ((vals - epoch).astype("timedelta64[us]")).astype(
-                np.float64
-            ) / 1e6
-            tUtc_sse_interp = np.interp(tTrace_sse, tFix_sse, tUtc_sse)
-            traceFix[k] = epoch + (
-                (tUtc_sse_interp * 1e6).astype(np.int64).astype("timedelta64[us]")
-            )
-        else:
-            traceFix[k] = np.interp(tTrace_sse, tFix_sse, vals)
+    for k in ["lons", "lats", "hgts"]:
+        traceFix[k] = np.interp(tTrace_sse, tLoc_sse, fix[k])
+
+    # I think this will break if the file covers a leap second
+    tUtc_sse_interp = np.interp(tTrace_sse, sse(fix["tutc"]), sse(fix["times"]))
+    traceFix["times"] = epoch + (
+        (tUtc_sse_interp * 1e6).astype(np.int64).astype("timedelta64[us]")
+    )
 
     return traceFix
 
 
-def main():
-    args = cli().parse_args()
+def findGPS(file):
+    # Name of the GPS file accompanying a digitizer file
+    if file.endswith(".ghog"):
+        return file.replace(".ghog", ".txt")
+    elif file.endswith(".dat"):
+        return file.replace(".dat", ".txt")
 
-    if args.output[-1] != "/":
-        args.output += "/"
+    return None
 
-    if not os.path.isdir(args.output):
-        raise ValueError("%s is not a directory." % args.output)
 
-    for file in args.files:
-        try:
-            if args.verbose:
-                print("Converting " + file)
-            try:
-                fd = open(file, "rb")
-            except Exception as e:
-                print(e)
-                continue
+def loadFix(file):
+    # Parse the GPS file accompanying a digitizer file, None if there isn't one
+    gpsFile = findGPS(file)
 
-            data = fd.read()
-            fd.close()
+    if not os.path.isfile(gpsFile):
+        print(
+            "%s - No GPS file found. No GPS information will be included in HDF5."
+            % file
+        )
+        return None
 
-            if len(data) < 46:
-                print(
-                    "%s - Incomplete file, only partial header present. Skipping conversion"
-                    % file
-                )
-                continue
+    fix = parseGPS(gpsFile)
 
-            header = parseHeader(data, file)
+    if fix == (-1, -1):
+        print(
+            "%s - Failed to parse GPS file. No GPS information will be included in HDF5."
+            % file
+        )
+        return None
 
-            if header == -1:
-                print("%s - Failed to parse file header" % file)
-                continue
+    return fix
+
+
+def gpsArray(fix):
+    # Get interpolated fix to right datatype for hdf5
+    return ghog.gps.gps_array(fix["lons"], fix["lats"], fix["hgts"], fix["times"])
+
+
+def outputFile(outdir, file, gps):
+    # Making output filename
+    fname = os.path.splitext(os.path.basename(file))[0]
 
+    if gps is not None:
+        time0 = gps["utc"][0][:19].decode()
+        time0 = time0.replace("-", "")
+        time0 = time0.replace(":", "")
+    else:
+        time0 = "unk"
+
+    return outdir + time0 + "_" + fname + ".h5"
+
+
+def convert(
+    file,
+    outdir,
+    stream=False,
+    block=BLOCK_TRACES,
+    verbose=False,
+    compression=None,
+    compact=False,
+):
+    # Convert one digitizer file. Returns the status, 0 on success, 1 if the file was
+    # skipped and -1 on failure, and the output file name if one was written.
+    if verbose:
+        print("Converting " + file)
+
+    if findGPS(file) is None:
+        print("%s - Unrecognized data file extension. Skipping conversion" % file)
+        return 1, None
+
+    try:
+        fd = open(file, "rb")
+    except Exception as e:
+        print(e)
+        return -1, None
+
+    with fd:
+        size = os.fstat(fd.fileno()).st_size
+
+        if size < 46:
+            print(
+                "%s - Incomplete file, only partial header present. Skipping conversion"
+                % file
+            )
+            return 1, None
+
+        # Map the file rather than reading it, traces are decoded as views. When
+        # streaming only trace times are read from the map, unless the file needs to
+        # be scanned for traces.
+        data = memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+
+        header = parseHeader(data, file)
+
+        if header == -1:
+            print("%s - Failed to parse file header" % file)
+            return -1, None
+
+        if stream:
+            runs = findTraces(data[46:], header["spt"], file)
+            ntrace = None if runs is None else sum(n for _, n in runs)
+        else:
             rx, tTrace = parseTraces(data[46:], header["spt"], file)
+            ntrace = None if tTrace is None else len(tTrace)
 
-            if len(data) - 46 < header["spt"] * 2:
-                print(
-                    "%s - Data file appears to be empty, not attempting to parse" % file
-                )
-                continue
+        if size - 46 < header["spt"] * 2:
+            print("%s - Data file appears to be empty, not attempting to parse" % file)
+            return 1, None
+
+        if ntrace is None:
+            print("%s - Failed to parse file data segment" % file)
+            return -1, None
+
+        if ntrace == 0:
+            print("%s - No complete traces found" % file)
+            return -1, None
+
+        fix = loadFix(file)
+
+        if stream:
+            # Only the first trace time is needed to name the output file
+            t0 = 46 + runs[0][0]
+            tTrace = np.array([bytes(data[t0 : t0 + 26])]).astype("datetime64[us]")
+
+        if fix is not None:
+            gps = gpsArray(interpFix(tTrace, fix, file, check=not stream))
+        else:
+            gps = None
+
+        outfile = outputFile(outdir, file, gps)
+
+        if verbose:
+            print("Saving ", outfile)
+
+        if stream:
+            blocks = readTraces(fd, header["spt"], runs, block, base=46)
+            status = streamH5(header, blocks, fix, file, outfile, compression)
+        else:
+            status = buildH5(header, rx, gps, outfile, compression, compact)
+
+        if status == -1:
+            print("%s - Failed to build HDF5." % file)
+            return -1, None
+
+    return 0, outfile
+
+
+def follow(
+    file,
+    outdir,
+    poll=FOLLOW_POLL,
+    block=BLOCK_TRACES,
+    verbose=False,
+    compression=None,
+):
+    # Convert a digitizer file while it is being written. Completed traces are
+    # appended with interpolated GPS to an HDF5 file in SWMR mode, so it can be read
+    # while it grows. Traces are held until the GPS log covers them, for at most
+    # FOLLOW_HOLD seconds. Returns 0 once the digitizer closes the file or on
+    # keyboard interrupt, and -1 on failure.
+    if verbose:
+        print("Following " + file)
+
+    gpsFile = findGPS(file)
+
+    if gpsFile is None:
+        print("%s - Unrecognized data file extension. Skipping conversion" % file)
+        return -1
+
+    try:
+        fd = open(file, "rb")
+    except Exception as e:
+        print(e)
+        return -1
 
-            if tTrace == -1:
-                print("%s - Failed to parse file data segment" % file)
-                continue
+    out = None
+    try:
+        with fd:
+            # Wait for the header and data segment magic bytes
+            while os.fstat(fd.fileno()).st_size < 50:
+                time.sleep(poll)
 
-            if file.endswith(".ghog"):
-                gpsFile = file.replace(".ghog", ".txt")
-            elif file.endswith(".dat"):
-                gpsFile = file.replace(".dat", ".txt")
-            else:
-                print("%s - Unrecognized data file extension. Skipping conversion")
+            data = fd.read(50)
+            header = parseHeader(data, file)
 
-            if not os.path.isfile(gpsFile):
+            if header == -1:
+                print("%s - Failed to parse file header" % file)
+                return -1
+
+            if data[46:50] != b"\xce\xfa\xed\xfe":
                 print(
-                    "%s - No GPS file found. No GPS information will be included in HDF5."
-                    % file
+                    file,
+                    "is improperly formed Groundhog digitizer file, missing data segment magic bytes.",
                 )
-                fix = None
-                gps = None
-            else:
-                fix = parseGPS(gpsFile)
-
-                if fix == (-1, -1):
-                    print(
-                        "%s - Failed to parse GPS file. No GPS information will be included in HDF5."
-                        % file
+                return -1
+
+            spt = header["spt"]
+            bpt = traceDtype(spt).itemsize
+            pos = 50  # offset of next trace
+            pending = np.zeros(0, dtype=traceDtype(spt))
+            nmea = None
+            gpsPos = 0  # offset of next GPS log line
+            fix = None
+            done = False  # digitizer closed the file
+            stop = False  # interrupted
+
+            while True:
+                size = os.fstat(fd.fileno()).st_size
+
+                # The digitizer writes the end magic bytes after the last trace
+                if not done and size >= 54 and (size - 54) % bpt == 0:
+                    fd.seek(size - 4)
+                    done = fd.read(4) == b"\xad\xde\xad\xde"
+
+                # Read completed traces, at most a block at a time
+                n = min((size - pos - 4 * done) // bpt, block)
+                if n > 0:
+                    fd.seek(pos)
+                    buf = fd.read(n * bpt)
+                    times = np.frombuffer(buf, dtype=timeDtype(spt))["time"]
+                    if not np.all(validTimes(times)):
+                        print(
+                            "%s - Damaged traces found. Convert again without --follow to recover intact traces."
+                            % file
+                        )
+                        return -1
+
+                    pending = np.append(
+                        pending, np.frombuffer(buf, dtype=traceDtype(spt))
                     )
-                    fix = None
-                    gps = None
-                else:
-                    fix = interpFix(tTrace, fix, file)
+                    pos += n * bpt
+
+                # Parse complete lines added to the GPS log
+                if os.path.isfile(gpsFile):
+                    with open(gpsFile, "rb") as gfd:
+                        gfd.seek(gpsPos)
+                        text = gfd.read()
+                    text = text[: text.rfind(b"\n") + 1]
+
+                    if len(text) > 0:
+                        gpsPos += len(text)
+                        more = parseNMEA(text)
+                        nmea = more if nmea is None else appendNMEA(nmea, more)
+                        if (
+                            len(nmea["tod"]) > 0
+                            and len(nmea["tloc"]) > 0
+                            and not np.isnat(nmea["date"])
+                        ):
+                            fix = stitchGPS(nmea)
+
+                # Write traces covered by GPS, or that have waited too long for it
+                if len(pending) > 0:
+                    tTrace = pending["time"].astype("datetime64[us]")
+                    if done or stop:
+                        ready = len(pending)
+                    else:
+                        limit = tTrace[-1] - np.timedelta64(int(FOLLOW_HOLD * 1e6), "us")
+                        if fix is not None:
+                            limit = max(limit, min(fix["tloc"][-1], fix["tutc"][-1]))
+                        ready = np.searchsorted(tTrace, limit, side="right")
+
+                    if ready > 0:
+                        rx = pending[:ready]["rx"].T
+                        tTrace = tTrace[:ready]
+                        pending = pending[ready:]
+
+                        if out is None and fix is None:
+                            print(
+                                "%s - No GPS fix available. No GPS information will be included in HDF5."
+                                % file
+                            )
+
+                        if (out is None and fix is not None) or (
+                            out is not None and gps0 is not None
+                        ):
+                            gps = gpsArray(interpFix(tTrace, fix, file, check=False))
+
+                            # Released without waiting longer for GPS, positions past
+                            # the end of the log are held at the last fix
+                            covered = min(fix["tloc"][-1], fix["tutc"][-1])
+                            if tTrace[-1] > covered:
+                                print(
+                                    "%s - GPS log ends %.1f s before traces up to %s, positions held at the last fix"
+                                    % (
+                                        file,
+                                        (tTrace[-1] - covered) / np.timedelta64(1, "s"),
+                                        tTrace[-1],
+                                    )
+                                )
+                        else:
+                            gps = None
+
+                        if out is None:
+                            outfile = outputFile(outdir, file, gps)
+                            if verbose:
+                                print("Saving ", outfile)
+
+                            out = h5py.File(outfile, "w", libver="latest")
+                            rx0, gps0 = createH5(out, header, rx, gps, compression)
+                            out.swmr_mode = True
+                            tFirst = tTrace[0]
+
+                        appendH5(rx0, gps0, rx, gps, flush=True)
+                        tLast = tTrace[-1]
+
+                if (done or stop) and n < block and len(pending) == 0:
+                    break
+
+                if n < block:
+                    try:
+                        time.sleep(poll)
+                    except KeyboardInterrupt:
+                        # Write what there is and finish
+                        stop = True
+
+            if out is None:
+                print("No traces to write")
+                return -1
+
+            if gps0 is not None:
+                checkFix(tFirst, tLast, fix, file)
+
+    finally:
+        if out is not None:
+            out.close()
+
+    # Index and distance of the complete file, like any other conversion. Datasets
+    # can't be added in SWMR mode, so the file is reopened.
+    if gps0 is not None:
+        with h5py.File(outfile, "r+") as fd:
+            gps = fd["raw"]["gps0"][:]
+            ghog.h5io.write_index(fd["raw"], gps)
+            ghog.h5io.write_distance(
+                fd["raw"], gps, **ghog.h5io.filters(compression)
+            )
 
-            # get fix to right datattype for hdf5
-            if fix is not None:
-                gps_t = np.dtype(
-                    [("lon", "f8"), ("lat", "f8"), ("hgt", "f8"), ("utc", "S26")]
-                )
-                gps = [None] * len(tTrace)
-                for i in range(len(tTrace)):
-                    gps[i] = tuple(
-                        [
-                            fix["lons"][i],
-                            fix["lats"][i],
-                            fix["hgts"][i],
-                            np.datetime_as_string(fix["times"][i]),
-                        ]
-                    )
-                gps = np.array(gps, dtype=gps_t)
+    if verbose:
+        print("Finished following " + file)
 
-            # Making output filename
-            if file.endswith(".ghog"):
-                fname = os.path.basename(file).replace(".ghog", "")
-            elif file.endswith(".dat"):
-                fname = os.path.basename(file).replace(".dat", "")
-            else:
-                print("%s - Unrecognized data file extension. Skipping conversion")
+    return 0
 
-            if gps is not None:
-                time0 = gps["utc"][0][:19].decode()
-                time0 = time0.replace("-", "")
-                time0 = time0.replace(":", "")
-            else:
-                time0 = "unk"
 
-            outfile = args.output + time0 + "_" + fname + ".h5"
+def fileHash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(2**24), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
 
-            if args.verbose:
-                print("Saving ", outfile)
 
-            if buildH5(header, rx, gps, outfile) == -1:
-                print("%s - Failed to build HDF5." % file)
-                continue
+def sourceState(file, entry=None):
+    # Size, mtime and content hash of a digitizer file and its GPS file. Hashes are
+    # reused from a manifest entry when size and mtime are unchanged.
+    state = {}
+    for key, path in (("ghog", file), ("txt", findGPS(file))):
+        if not os.path.isfile(path):
+            state[key] = None
+            continue
 
+        st = os.stat(path)
+        src = {"size": st.st_size, "mtime": st.st_mtime_ns}
+        prev = entry["sources"][key] if entry is not None else None
+        if prev is not None and (prev["size"], prev["mtime"]) == (src["size"], src["mtime"]):
+            src["sha256"] = prev["sha256"]
+        else:
+            src["sha256"] = fileHash(path)
+        state[key] = src
+
+    return state
+
+
+def outputOptions(stream, compression, compact):
+    # Conversion options that change the output, recorded in manifest entries
+    return {
+        "version": FORMAT_VERSION,
+        "stream": stream,
+        "compression": compression,
+        "compact": compact,
+    }
+
+
+def isCurrent(entry, state, options):
+    # Whether a manifest entry's output is up to date with the current sources and
+    # was written with the same options
+    if entry is None or not os.path.isfile(entry["output"]):
+        return False
+
+    if entry.get("options") != options:
+        return False
+
+    for key, src in state.items():
+        prev = entry["sources"][key]
+        if src is None or prev is None:
+            if src is not prev:
+                return False
+        elif (src["size"], src["sha256"]) != (prev["size"], prev["sha256"]):
+            return False
+
+    return True
+
+
+def loadManifest(path):
+    if not os.path.isfile(path):
+        return {}
+
+    with open(path, "r") as fd:
+        return json.load(fd)
+
+
+def saveManifest(path, manifest):
+    # Written through a temporary file, like the HDF5 output
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fd:
+        json.dump(manifest, fd, indent=1)
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def noRedirect():
+    # Leaves stdout alone, contextlib.nullcontext needs Python 3.7
+    yield
+
+
+def convertLogged(
+    file,
+    entry,
+    outdir,
+    stream,
+    block,
+    verbose,
+    incremental=False,
+    capture=False,
+    compression=None,
+    compact=False,
+):
+    # Run convert, catching any failure. With capture the printed messages are
+    # returned rather than written to stdout, so parallel workers can be reported
+    # in order. When incremental, files whose manifest entry is current are skipped
+    # and the new manifest entry for the file is returned.
+    log = io.StringIO()
+    record = None
+    options = outputOptions(stream, compression, compact)
+    with contextlib.redirect_stdout(log) if capture else noRedirect():
+        try:
+            if incremental and findGPS(file) is not None:
+                state = sourceState(file, entry)
+                if isCurrent(entry, state, options):
+                    if verbose:
+                        print("%s - Output is up to date. Skipping conversion" % file)
+                    return 1, log.getvalue(), dict(entry, sources=state)
+
+            status, outfile = convert(
+                file, outdir, stream, block, verbose, compression, compact
+            )
+
+            if incremental and status == 0:
+                record = {
+                    "sources": state,
+                    "options": options,
+                    "output": os.path.abspath(outfile),
+                }
         except Exception as e:
             print(e)
             print(traceback.format_exc())
             print("%s - Unanticipated failure. Skipping conversion." % file)
+            status = -1
+
+    return status, log.getvalue(), record
+
+
+def main():
+    args = cli().parse_args()
+
+    if args.output[-1] != "/":
+        args.output += "/"
+
+    if not os.path.isdir(args.output):
+        raise ValueError("%s is not a directory." % args.output)
+
+    if args.block <= 0:
+        raise ValueError("block must be positive.")
+
+    if args.jobs <= 0:
+        raise ValueError("jobs must be positive.")
+
+    if args.compact and (args.stream or args.follow):
+        raise ValueError("compact cannot be combined with stream or follow.")
+
+    if args.follow:
+        if args.jobs != 1 or args.incremental:
+            raise ValueError("follow cannot be combined with jobs or incremental.")
+
+        if args.poll <= 0:
+            raise ValueError("poll must be positive.")
+
+        for file in args.files:
+            try:
+                follow(
+                    file,
+                    args.output,
+                    args.poll,
+                    args.block,
+                    args.verbose,
+                    args.compression,
+                )
+            except Exception as e:
+                print(e)
+                print(traceback.format_exc())
+                print("%s - Unanticipated failure. Skipping conversion." % file)
+
+        return 0
+
+    manifestFile = args.output + MANIFEST
+    manifest = loadManifest(manifestFile) if args.incremental else {}
+    keys = [os.path.abspath(file) for file in args.files]
+    entries = [manifest.get(key) for key in keys]
+
+    run = functools.partial(
+        convertLogged,
+        outdir=args.output,
+        stream=args.stream,
+        block=args.block,
+        verbose=args.verbose,
+        incremental=args.incremental,
+        compression=args.compression,
+        compact=args.compact,
+    )
+
+    # Workers are only started if the pool is used
+    counts = {0: 0, 1: 0, -1: 0}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        if args.jobs == 1:
+            results = map(run, args.files, entries)
+        else:
+            results = pool.map(
+                functools.partial(run, capture=True), args.files, entries
+            )
+
+        for key, (status, log, record) in zip(keys, results):
+            print(log, end="")
+            counts[status] += 1
+
+            # Saved as we go so an interrupted run keeps what it finished
+            if record is not None:
+                manifest[key] = record
+                saveManifest(manifestFile, manifest)
+
+    print(
+        "Converted %d, failed %d, skipped %d of %d file(s)"
+        % (counts[0], counts[-1], counts[1], len(args.files))
+    )
 
     return 0
 
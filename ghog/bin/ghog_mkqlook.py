@@ -28,12 +28,20 @@ def cli():
         default="raw",
         help="Group to load from HDF5 file (default = raw).",
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of filtering threads (default = all CPUs).",
+    )
     parser.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
     return parser
 
 
 def main():
     args = cli().parse_args()
+    ghog.config.workers = args.workers
 
     if args.verbose:
         print("Generating figure from:")
@@ -9,7 +9,8 @@ import time
 
 import h5py
 import numpy as np
-import pyproj
+
+import ghog.geodesy
 
 
 def cli():
@@ -136,7 +137,7 @@ def gensegy(header, rx, fix, file):
         f.write(build_binhead(spt, ntrace, header["fs"]))
 
         # Convert to utm
-        xform = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:32607")
+        xform = ghog.geodesy.transformer("EPSG:4326", "EPSG:32607")
 
         x, y = xform.transform(fix[:, 1], fix[:, 0])
         print(x)
@@ -1,6 +1,8 @@
 # Re-used input validation routines
 import numpy as np
 
+import ghog.gps
+
 
 def check_data(data):
     expected_keys = ["rx", "gps", "attrs"]
@@ -17,16 +19,20 @@ def check_data(data):
     check_attrs(data["attrs"])
     check_rx_gps_match(data["rx"], data["gps"])
 
+    if "dist" in data:
+        check_dist(data["dist"], data["gps"])
+
 
 def check_gps(gps):
     if type(gps) != np.ndarray:
         raise TypeError("gps is not a numpy ndarray.")
 
-    gpst = [("lon", "<f8"), ("lat", "<f8"), ("hgt", "<f8"), ("utc", "S26")]
-    if gps.dtype != gpst:
+    gpst = ghog.gps.GPS_DTYPE
+    gpst_epoch = ghog.gps.GPS_EPOCH_DTYPE
+    if gps.dtype != gpst and gps.dtype != gpst_epoch:
         raise TypeError(
-            "gps has unrecognized datatype.\n\texpected: %s\n\actual: %s"
-            % (str(gpst), gps.dtype)
+            "gps has unrecognized datatype.\n\texpected: %s\n\tor: %s\n\actual: %s"
+            % (str(gpst), str(gpst_epoch), gps.dtype)
         )
 
 
@@ -52,6 +58,24 @@ def check_rx(rx):
         raise ValueError("rx is not two dimensional.")
 
 
+def check_inplace(rx, floating=True):
+    if not rx.flags.writeable:
+        raise ValueError("rx is read only and cannot be processed in place.")
+
+    if floating and not np.issubdtype(rx.dtype, np.floating):
+        raise TypeError("rx must be floating point to be processed in place.")
+
+
+def check_dist(dist, gps):
+    if type(dist) != np.ndarray:
+        raise TypeError("dist is not a numpy ndarray.")
+
+    if dist.shape != gps.shape:
+        raise ValueError(
+            "Number of distances in dist does not equal number of fixes in gps."
+        )
+
+
 def check_rx_gps_match(rx, gps):
     if len(gps) != rx.shape[1]:
         raise ValueError(
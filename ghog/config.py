@@ -0,0 +1,53 @@
+# Package wide processing settings
+import os
+
+import numpy as np
+
+DTYPES = [np.float32, np.float64]  # supported processing precisions
+
+dtype = np.float64  # floating point type of processed data
+
+workers = None  # threads for filtering and migration, None for all CPUs
+
+# Working memory of each block of in place processing, in double precision. Blocks
+# hold as many samples in single precision, so they take half of it.
+block_bytes = 2**25
+
+stolt_cache_bytes = 0  # Stolt remap tables kept between migrations, 0 to keep none
+
+
+def float_type():
+    """Get the floating point type of processed data, from ghog.config.dtype.
+
+    Returns:
+        numpy dtype, float32 or float64.
+    """
+    if np.dtype(dtype) not in [np.dtype(t) for t in DTYPES]:
+        raise ValueError(
+            "Invalid ghog.config.dtype: %s. dtype must be one of: %s"
+            % (dtype, [np.dtype(t).name for t in DTYPES])
+        )
+
+    return np.dtype(dtype)
+
+
+def thread_count(workers=None):
+    """Get the number of threads to use.
+
+    Args:
+        workers: Number of threads, or None to use ghog.config.workers, which when None
+            is all CPUs (default = None).
+
+    Returns:
+        Number of threads.
+    """
+    if workers is None:
+        workers = globals()["workers"]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 0:
+        raise ValueError("workers must be positive.")
+
+    return workers
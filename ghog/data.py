@@ -0,0 +1,54 @@
+# Groundhog data container
+import collections.abc
+
+KEYS = ["rx", "gps", "attrs", "dist"]  # entries of a data container, dist is optional
+
+
+class GhogData(collections.abc.MutableMapping):
+    """Groundhog data container.
+
+    Behaves like a Groundhog data dictionary (rx, gps, attrs), with an optional
+    along-track distance (dist). Processing functions return it and share the entries
+    they leave unchanged with their input rather than copying them, so copy an entry
+    before modifying it in place if the input is still needed.
+
+    Args:
+        rx: 2D data array.
+        gps: numpy structured array with per-column positions and times.
+        attrs: Data attributes.
+        dist: Along-track distance of each trace (default = None : no distance).
+    """
+
+    __slots__ = ("rx", "gps", "attrs", "dist")
+
+    def __init__(self, rx, gps, attrs, dist=None):
+        self.rx = rx
+        self.gps = gps
+        self.attrs = attrs
+        self.dist = dist
+
+    def __getitem__(self, key):
+        if key not in KEYS or getattr(self, key) is None:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key != "dist" or self.dist is None:
+            raise KeyError(key)
+        self.dist = None
+
+    def __iter__(self):
+        return iter([key for key in KEYS if getattr(self, key) is not None])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return "GhogData(%s)" % ", ".join(
+            "%s=%s" % (key, type(self[key]).__name__) for key in self
+        )
@@ -1,10 +1,10 @@
 # Generate radargram figure
 import numpy as np
 import matplotlib.pyplot as plt
-import pyproj
 
 import ghog.checks
 import ghog.constants
+import ghog.geodesy
 
 
 def figure(
@@ -79,7 +79,6 @@ def figure(
         raise ValueError("pdepth cannot be less than one.")
 
     rx = np.copy(data["rx"])
-    gps = data["gps"]
     attrs = data["attrs"]
 
     # Set up x extent
@@ -88,10 +87,7 @@ def figure(
         xmax = rx.shape[1]
         xlabel = xlabel or "Trace index"
     elif xunit == "distance":
-        xform = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:4978")
-        x, y, z = xform.transform(gps["lat"], gps["lon"], gps["hgt"])
-        steps = np.sqrt(np.diff(x) ** 2 + np.diff(y) ** 2 + np.diff(z) ** 2)
-        xmax = np.sum(steps)
+        xmax = ghog.geodesy.distance(data)[-1]
         xlabel = xlabel or "Distance along profile (m)"
 
     # Set up y extent
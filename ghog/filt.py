@@ -1,14 +1,34 @@
 # Filtering wrapper
+import collections
+import concurrent.futures
+import functools
+import itertools
+
 import numpy as np
+import scipy.fft
 import scipy.signal
 
 import ghog.checks
+import ghog.config
+import ghog.data
+import ghog.h5io
+
+METHODS = ["iir", "fft"]  # filter implementations
+
+PADLEN = 256  # samples of odd extension at each edge
+
+STREAM_TRACES = 4096  # traces per block of a streamed filter
+
+STREAM_TAIL = 1e-12  # impulse response energy left out of a streamed filter
 
 
-def filt(data, passband, axis=0, order=4):
+def filt(data, passband, axis=0, order=4, method="iir", workers=None, inplace=False):
     """Apply a Butterworth filter along a data axis.
 
-    Forward and backward for zero phase shift.
+    Forward and backward for zero phase shift. The "fft" method applies the same squared
+    magnitude response in the frequency domain, which is faster for long axes and many
+    traces. Both extend the edges the same way, results differ slightly within about an
+    impulse response of the ends.
 
     Args:
         data: Groundhog data dictionary (rx, gps, attrs).
@@ -18,9 +38,14 @@ def filt(data, passband, axis=0, order=4):
             create a low pass or high pass filter.
         axis: Axis to filter along (default = 0).
         order: Filter order (default = 4).
+        method: Filter implementation, valid options are ["iir", "fft"] (default = "iir").
+        workers: Number of threads, the "iir" method filters blocks of traces or rows
+            concurrently (default = None : ghog.config.workers).
+        inplace: Filter rx in place, a block at a time, it must be floating point
+            (default = False). Otherwise rx is filtered in ghog.config.dtype.
 
     Returns:
-        Dictionary containing the filtered 2D data array (rx), numpy structured array with per-column
+        GhogData containing the filtered 2D data array (rx), numpy structured array with per-column
         positions and times (gps), and data attributes (attrs).
     """
     ghog.checks.check_data(data)
@@ -34,6 +59,13 @@ def filt(data, passband, axis=0, order=4):
     if order <= 0:
         raise ValueError("Order cannot be 0 or negative.")
 
+    if method not in METHODS:
+        raise ValueError(
+            "Invalid method argument: %s. method must be one of: %s" % (method, METHODS)
+        )
+
+    workers = ghog.config.thread_count(workers)
+
     if passband[0] is None:
         Wn = passband[1]
         btype = "lowpass"
@@ -41,7 +73,7 @@ def filt(data, passband, axis=0, order=4):
         Wn = passband[0]
         btype = "highpass"
     else:
-        Wn = passband
+        Wn = tuple(passband)
         btype = "bandpass"
 
     if axis == 0:
@@ -51,10 +83,307 @@ def filt(data, passband, axis=0, order=4):
     else:
         fs = None
 
-    sos = scipy.signal.iirfilter(
+    rx = data["rx"]
+    if inplace:
+        # Blocks of about ghog.config.block_bytes of double precision samples, each
+        # written back over its input
+        ghog.checks.check_inplace(rx)
+        dtype = rx.dtype
+        nblock = max(workers, int(np.ceil(8 * rx.size / ghog.config.block_bytes)))
+        out = rx
+    else:
+        dtype = ghog.config.float_type()
+        nblock = workers
+        out = None
+
+    sos = design(order, Wn, btype, fs)
+
+    if method == "fft" and not inplace:
+        rx = fft_filter(sos, rx, axis, fs, workers, dtype)
+    elif method == "fft":
+        rx = by_blocks(
+            lambda x: fft_filter(sos, x, axis, fs, dtype=dtype),
+            rx,
+            axis,
+            nblock,
+            workers,
+            out,
+            dtype,
+        )
+    else:
+        # Sections in the data type so filtering doesn't promote single precision
+        sos = sos.astype(dtype)
+        rx = by_blocks(
+            lambda x: iir_filter(sos, x, axis, dtype),
+            rx,
+            axis,
+            nblock,
+            workers,
+            out,
+            dtype,
+        )
+
+    return ghog.data.GhogData(rx, data["gps"], data["attrs"], data.get("dist"))
+
+
+@functools.lru_cache(maxsize=64)
+def design(order, Wn, btype, fs):
+    # Butterworth second order sections, designed once for each filter
+    return scipy.signal.iirfilter(
         order, Wn, btype=btype, analog=False, ftype="butter", output="sos", fs=fs
     )
 
-    rx = scipy.signal.sosfiltfilt(sos, data["rx"], axis=axis, padlen=256)
 
-    return {"rx": rx, "gps": np.copy(data["gps"]), "attrs": dict(data["attrs"])}
+def by_blocks(filter, x, axis=0, nblock=1, workers=1, out=None, dtype=np.float64):
+    # Filter x along an axis in blocks across the other axis, into out or a new array
+    # of dtype. With several workers blocks are filtered concurrently, scipy releases
+    # the GIL while filtering.
+    other = 1 - axis
+    nblock = min(nblock, x.shape[other])
+
+    if nblock <= 1 and out is None:
+        return filter(x)
+
+    if out is None:
+        out = np.empty(x.shape, dtype=dtype)
+    edges = np.linspace(0, x.shape[other], nblock + 1).astype(int)
+
+    def run(i):
+        block = [slice(None), slice(None)]
+        block[other] = slice(edges[i], edges[i + 1])
+        block = tuple(block)
+        out[block] = filter(x[block])
+
+    if workers > 1 and nblock > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(run, range(nblock)))
+    else:
+        for i in range(nblock):
+            run(i)
+
+    return out
+
+
+def iir_filter(sos, x, axis=0, dtype=np.float64):
+    # Zero phase filter x along an axis with sos in dtype. Integer data that scipy
+    # converts to dtype anyway isn't copied first.
+    if np.result_type(sos, x) != dtype:
+        x = x.astype(dtype)
+    return scipy.signal.sosfiltfilt(sos, x, axis=axis, padlen=PADLEN)
+
+
+def fft_filter(sos, x, axis=0, fs=None, workers=1, dtype=np.float64):
+    # Zero phase filter x along an axis with the squared magnitude response of sos, as
+    # sosfiltfilt would, in dtype. Edges are odd extended like sosfiltfilt, then zero
+    # padded to a fast FFT length.
+    n = x.shape[axis]
+    padlen = min(PADLEN, n - 1)
+    m = scipy.fft.next_fast_len(n + 2 * padlen, real=True)
+
+    def index(start, stop=None, step=None):
+        # Slice along the filter axis
+        sl = [slice(None)] * x.ndim
+        sl[axis] = slice(start, stop, step)
+        return tuple(sl)
+
+    shape = list(x.shape)
+    shape[axis] = m
+    xpad = np.zeros(shape, dtype=dtype)
+    xpad[index(padlen, padlen + n)] = x
+    xpad[index(0, padlen)] = 2 * x[index(0, 1)] - x[index(padlen, 0, -1)]
+    stop = n - padlen - 2 if n > padlen + 1 else None
+    xpad[index(padlen + n, n + 2 * padlen)] = (
+        2 * x[index(n - 1, n)] - x[index(n - 2, stop, -1)]
+    )
+
+    # Normalized frequencies are relative to a nyquist of one
+    fs = 2.0 if fs is None else fs
+    w, h = scipy.signal.sosfreqz(sos, worN=scipy.fft.rfftfreq(m, d=1.0 / fs), fs=fs)
+    gain = (np.abs(h) ** 2).astype(dtype)
+    gain = gain.reshape([len(h) if i == axis else 1 for i in range(x.ndim)])
+
+    X = scipy.fft.rfft(xpad, axis=axis, overwrite_x=True, workers=workers)
+    del xpad
+    X *= gain
+    y = scipy.fft.irfft(X, n=m, axis=axis, overwrite_x=True, workers=workers)
+    del X
+
+    return np.ascontiguousarray(y[index(padlen, padlen + n)])
+
+
+def filt_stream(sources, passband, order=4, block=STREAM_TRACES, halfwidth=None):
+    """Apply a Butterworth filter along traces of consecutive profiles.
+
+    Filters the profiles as if they were concatenated into one and filtered with
+    filt(..., axis=1), reading and filtering a block of traces at a time so memory is
+    bounded by the block size and halfwidth. Away from the ends of the whole profile
+    the zero phase response of filt is truncated to an impulse response of halfwidth
+    traces either side, so there are no transients where the sources meet. The first
+    and last halfwidth traces are filtered with filt from the 2 * halfwidth traces at
+    each end, so its end transients are kept. With the default halfwidth the result
+    matches filt to within about 1e-5 of the largest sample.
+
+    Args:
+        sources: Iterable of Groundhog data dictionaries (rx, gps, attrs), or open HDF5
+            groups from ghog.open, in profile order. All must have the same number of
+            samples per trace and the same stack_interval.
+        passband: (low, high) Tuple giving passband for filter, in wavenumber if
+            stack_interval exists in attrs, otherwise fraction of nyquist. Use None to
+            denote no filter edge and create a low pass or high pass filter.
+        order: Filter order (default = 4).
+        block: Traces filtered at a time (default = 4096).
+        halfwidth: Half width of the impulse response in traces (default = None : as
+            wide as needed to hold all but STREAM_TAIL of its energy).
+
+    Yields:
+        GhogData containing up to block filtered traces (rx), numpy structured array with
+        per-column positions and times (gps), and data attributes (attrs), in profile
+        order. Each comes from a single source. Traces are filtered in
+        ghog.config.dtype.
+    """
+    if passband == (None, None):
+        raise ValueError("Both filter edges cannot be None.")
+
+    if order <= 0:
+        raise ValueError("Order cannot be 0 or negative.")
+
+    if block < 1:
+        raise ValueError("block must be at least one trace.")
+
+    if passband[0] is None:
+        Wn = passband[1]
+        btype = "lowpass"
+    elif passband[1] is None:
+        Wn = passband[0]
+        btype = "highpass"
+    else:
+        Wn = tuple(passband)
+        btype = "bandpass"
+
+    blocks = stream_blocks(sources, block)
+    first = next(blocks, None)
+    if first is None:
+        return
+
+    attrs = first["attrs"]
+    fs = 1.0 / attrs["stack_interval"] if "stack_interval" in attrs else None
+    sos = design(order, Wn, btype, fs)
+    h = zero_phase_response(sos, halfwidth)
+    h = h.astype(first["rx"].dtype)
+    w = len(h) // 2
+    sos = sos.astype(first["rx"].dtype)
+
+    # Blocks waiting for w traces after them, the w traces before the first of them,
+    # the first and last w traces of the profile filtered like filt, and the last 2w
+    # traces to filter the end with
+    queue = collections.deque([first])
+    nqueue = first["rx"].shape[1]
+    before = np.zeros((first["rx"].shape[0], w), dtype=first["rx"].dtype)
+    head = None
+    tail = None
+    last = first["rx"][:, -2 * w :]
+    pos = 0  # first trace of the first queued block
+    ntrace = None  # traces in the profile, once it has ended
+
+    def emit():
+        # Filter the first queued block, then replace traces within w of the ends.
+        # Convolving past the ends only touches those, so before starts as zeros.
+        nonlocal before, nqueue, pos
+        data = queue.popleft()
+        n = data["rx"].shape[1]
+        nqueue -= n
+        after = np.concatenate([d["rx"] for d in queue], axis=1)[:, :w]
+        rx = np.concatenate([before, data["rx"], after], axis=1)
+        before = rx[:, n : n + w]
+        data["rx"] = scipy.signal.fftconvolve(
+            rx, h[np.newaxis, :], mode="valid", axes=1
+        )
+
+        stop = min(pos + n, head.shape[1])
+        if pos < stop:
+            data["rx"][:, : stop - pos] = head[:, pos:stop]
+
+        if tail is not None:
+            t0 = ntrace - tail.shape[1]
+            start = max(pos, t0)
+            if start < pos + n:
+                data["rx"][:, start - pos :] = tail[:, start - t0 : pos + n - t0]
+
+        pos += n
+        return data
+
+    for data in itertools.chain(blocks, [None]):
+        if data is not None:
+            if data["rx"].shape[0] != first["rx"].shape[0]:
+                raise ValueError("Sources have different numbers of samples per trace.")
+            if data["attrs"].get("stack_interval") != attrs.get("stack_interval"):
+                raise ValueError("Sources have different stack intervals.")
+
+            queue.append(data)
+            nqueue += data["rx"].shape[1]
+            last = np.concatenate([last, data["rx"]], axis=1)[:, -2 * w :]
+
+        # Filter the start once enough traces are in, or the profile has ended
+        if head is None and (nqueue >= 2 * w or data is None):
+            x = np.concatenate([d["rx"] for d in queue], axis=1)[:, : 2 * w]
+            head = edge_filter(sos, x)[:, :w]
+
+        if data is None:
+            # Filter the end, and pad past it
+            ntrace = pos + nqueue
+            tail = edge_filter(sos, last)[:, -w:]
+            queue.append({"rx": np.zeros_like(before)})
+            nqueue += w
+
+        while head is not None and len(queue) > 1:
+            if nqueue - queue[0]["rx"].shape[1] < w:
+                break
+            yield emit()
+
+
+def stream_blocks(sources, block):
+    # Blocks of traces of each source as data dictionaries in ghog.config.dtype, read
+    # as needed from open HDF5 groups
+    dtype = ghog.config.float_type()
+    for source in sources:
+        if isinstance(source, ghog.h5io.LazyGroup):
+            ntrace = source.shape[1]
+        else:
+            ghog.checks.check_data(source)
+            ntrace = source["rx"].shape[1]
+
+        for start in range(0, ntrace, block):
+            traces = slice(start, start + block)
+            if isinstance(source, ghog.h5io.LazyGroup):
+                data = source.read(traces, dtype)
+            else:
+                data = {"rx": source["rx"][:, traces], "gps": source["gps"][traces]}
+            yield ghog.data.GhogData(
+                np.asarray(data["rx"], dtype=dtype), data["gps"], source["attrs"]
+            )
+
+
+def zero_phase_response(sos, halfwidth=None):
+    # Two sided impulse response of filtering forward and backward with sos, truncated
+    # to halfwidth either side of the center
+    n = 2**16 if halfwidth is None else scipy.fft.next_fast_len(4 * halfwidth + 2)
+    w, h = scipy.signal.sosfreqz(sos, worN=scipy.fft.rfftfreq(n, d=0.5), fs=2.0)
+    h = np.fft.fftshift(scipy.fft.irfft(np.abs(h) ** 2, n=n))
+    center = n // 2
+
+    if halfwidth is None:
+        # Narrowest window leaving out no more than STREAM_TAIL of the energy
+        energy = h**2
+        outside = np.sum(energy) - np.cumsum(
+            energy[center:] + np.append(0, energy[center - 1 :: -1])[: n - center]
+        )
+        inside = outside <= STREAM_TAIL * np.sum(energy)
+        halfwidth = int(np.argmax(inside)) if np.any(inside) else center - 1
+
+    return h[center - halfwidth : center + halfwidth + 1]
+
+
+def edge_filter(sos, x):
+    # Filter traces at an end of a profile like filt(..., axis=1), within an impulse
+    # response of that end
+    return scipy.signal.sosfiltfilt(sos, x, axis=1, padlen=min(PADLEN, x.shape[1] - 1))
@@ -1,26 +1,37 @@
 import numpy as np
 
 import ghog.checks
+import ghog.config
+import ghog.data
 
 
-def gain(data, tpow=1):
+def gain(data, tpow=1, inplace=False):
     """Apply gain to traces.
 
     Args:
         data: Groundhog data dictionary (rx, gps, attrs).
         tpow: Power of time gain to apply to each trace (default = 1 : linear gain).
+        inplace: Gain rx in place, it must be floating point (default = False).
+            Otherwise the gained array is ghog.config.dtype.
 
     Returns:
-        Dictionary containing the gained 2D data array (rx), numpy structured array with
+        GhogData containing the gained 2D data array (rx), numpy structured array with
         per-column positions and times (gps), and data attributes (attrs).
     """
 
-    rx = np.copy(data["rx"])
+    rx = data["rx"]
     attrs = data["attrs"]
 
     t = (np.arange(rx.shape[0]) - attrs["pre_trig"]) / attrs["fs"]
     gain = t**tpow
     gain = gain / np.max(gain)
-    rxgain = rx * gain[:, np.newaxis]
 
-    return {"rx": rxgain, "gps": np.copy(data["gps"]), "attrs": attrs}
+    if inplace:
+        ghog.checks.check_inplace(rx)
+        rx *= gain[:, np.newaxis].astype(rx.dtype)
+        rxgain = rx
+    else:
+        dtype = ghog.config.float_type()
+        rxgain = np.multiply(rx, gain[:, np.newaxis].astype(dtype), dtype=dtype)
+
+    return ghog.data.GhogData(rxgain, data["gps"], attrs, data.get("dist"))
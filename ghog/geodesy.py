@@ -0,0 +1,89 @@
+# Shared coordinate transformers and along-track distance
+import collections
+import functools
+import hashlib
+
+import numpy as np
+import pyproj
+
+CACHE_TRACKS = 8  # along-track distances kept for recently seen tracks
+
+# Cumulative distances of recently seen tracks, by track key
+tracks = collections.OrderedDict()
+
+
+@functools.lru_cache(maxsize=None)
+def transformer(crs_from, crs_to):
+    """Get a coordinate transformer, built once for each pair of coordinate systems.
+
+    Args:
+        crs_from: Coordinate reference system to transform from, e.g. "EPSG:4326".
+        crs_to: Coordinate reference system to transform to.
+
+    Returns:
+        pyproj Transformer.
+    """
+    return pyproj.Transformer.from_crs(crs_from, crs_to)
+
+
+def track_key(gps):
+    """Get a key identifying the positions of a track.
+
+    Args:
+        gps: numpy structured array with per-column positions and times.
+
+    Returns:
+        Hex digest of the longitudes, latitudes and heights.
+    """
+    h = hashlib.sha1()
+    for k in ["lon", "lat", "hgt"]:
+        h.update(np.ascontiguousarray(gps[k], dtype="<f8").tobytes())
+    return h.hexdigest()
+
+
+def distance(data):
+    """Get the cumulative along-track distance of each trace.
+
+    Distance is measured along straight lines between consecutive positions in
+    Earth-centered, Earth-fixed coordinates. It is taken from data["dist"] when that was
+    computed from the same positions, or from recently computed tracks, so a track is
+    only projected once.
+
+    Args:
+        data: Groundhog data dictionary (rx, gps, attrs), optionally with along-track
+            distance (dist) computed from the positions identified by attrs["dist_key"].
+
+    Returns:
+        numpy array of along-track distance (m), starting at zero for the first trace.
+    """
+    if "dist" in data and data["attrs"].get("dist_key") == track_key(data["gps"]):
+        return data["dist"]
+
+    return track_distance(data["gps"])
+
+
+def track_distance(gps):
+    """Get the cumulative along-track distance of each position of a track.
+
+    Args:
+        gps: numpy structured array with per-column positions and times.
+
+    Returns:
+        numpy array of along-track distance (m), starting at zero for the first position.
+    """
+    key = track_key(gps)
+
+    if key in tracks:
+        tracks.move_to_end(key)
+        return tracks[key]
+
+    xform = transformer("EPSG:4326", "EPSG:4978")
+    x, y, z = xform.transform(gps["lat"], gps["lon"], gps["hgt"])
+    steps = np.sqrt(np.diff(x) ** 2 + np.diff(y) ** 2 + np.diff(z) ** 2)
+    dist = np.append(0, np.cumsum(steps))
+
+    tracks[key] = dist
+    if len(tracks) > CACHE_TRACKS:
+        tracks.popitem(last=False)
+
+    return dist
@@ -0,0 +1,50 @@
+# GNSS position and time arrays
+import numpy as np
+
+# Per-column positions and UTC time strings
+GPS_DTYPE = [("lon", "<f8"), ("lat", "<f8"), ("hgt", "<f8"), ("utc", "S26")]
+
+# With times also as integer microseconds since the Unix epoch
+GPS_EPOCH_DTYPE = GPS_DTYPE + [("epoch", "<i8")]
+
+
+def gps_array(lon, lat, hgt, times, epoch=True):
+    """Build a numpy structured array of per-column positions and times.
+
+    Args:
+        lon: Longitudes.
+        lat: Latitudes.
+        hgt: Heights.
+        times: Times, anything that casts to numpy datetime64[us].
+        epoch: Include the integer epoch time column (default = True).
+
+    Returns:
+        numpy structured array with per-column positions and times (gps).
+    """
+    times = np.asarray(times).astype("datetime64[us]")
+
+    gps = np.empty(len(times), dtype=GPS_EPOCH_DTYPE if epoch else GPS_DTYPE)
+    gps["lon"] = lon
+    gps["lat"] = lat
+    gps["hgt"] = hgt
+    gps["utc"] = np.datetime_as_string(times)
+    if epoch:
+        gps["epoch"] = times.astype(np.int64)
+
+    return gps
+
+
+def gps_times(gps):
+    """Get the times of a numpy structured array of per-column positions and times.
+
+    Args:
+        gps: numpy structured array with per-column positions and times.
+
+    Returns:
+        numpy datetime64[us] array of times, cast from the epoch time column if present
+        and parsed from the UTC time strings otherwise.
+    """
+    if "epoch" in gps.dtype.names:
+        return gps["epoch"].astype("datetime64[us]")
+
+    return gps["utc"].astype("datetime64[us]")
@@ -1,4 +1,5 @@
 # Groundhog HDF5 I/O operations
+import collections.abc
 import os
 import warnings
 
@@ -6,36 +7,322 @@ import h5py
 import numpy as np
 
 import ghog.checks
+import ghog.data
+import ghog.geodesy
+import ghog.gps
 
+COMPRESSION = [None, "gzip", "lzf"]  # supported HDF5 compression filters
+CHUNK_BYTES = 2**20  # target size of a chunk of traces in compressed datasets
+INDEX_TRACES = 1024  # traces per block of the time and position index
 
-def load(file, group="raw"):
-    """Load a group from a Groundhog HDF5 file into memory.
+# Time and position extents of each block of traces in a group
+INDEX_DTYPE = [
+    ("start", "<i8"),
+    ("stop", "<i8"),
+    ("tmin", "<i8"),
+    ("tmax", "<i8"),
+    ("lonmin", "<f8"),
+    ("lonmax", "<f8"),
+    ("latmin", "<f8"),
+    ("latmax", "<f8"),
+]
+
+
+class LazyGroup(collections.abc.Mapping):
+    """Group of a Groundhog HDF5 file that is read on demand.
+
+    Backed by the HDF5 datasets, so opening is cheap and only what is used is read.
+    Indexing with a trace index or slice reads just those traces into a Groundhog data
+    dictionary. Indexing with "rx", "gps" or "attrs" reads the whole of that entry once
+    and keeps it, so the group can be passed to processing functions in place of a
+    data dictionary. Close it, or use it as a context manager, when done.
 
     Args:
         file: Groundhog HDF5 data file.
-        group: Group in the HDF5 file to load (default = "raw").
-
-    Returns:
-        Dictionary containing the 2D data array (rx), numpy structured array with per-column
-        positions and times (gps), and data attributes (attrs).
+        group: Group in the HDF5 file to open (default = "raw").
     """
-    if type(file) != str:
-        raise TypeError("file is not a string.")
 
-    if type(group) != str:
-        raise TypeError("group is not a string.")
+    def __init__(self, file, group="raw"):
+        if type(file) != str:
+            raise TypeError("file is not a string.")
+
+        if type(group) != str:
+            raise TypeError("group is not a string.")
 
-    if not os.path.isfile(file):
-        raise ValueError("%s is not a file." % file)
+        if not os.path.isfile(file):
+            raise ValueError("%s is not a file." % file)
 
-    with h5py.File(file, mode="r") as fd:
-        rx = fd[group]["rx0"][:]
+        # SWMR read so files still being written by ghog_mkh5 --follow can be loaded
+        self.fd = h5py.File(file, mode="r", swmr=True)
         try:
-            gps = fd[group]["ppp0"][:]
-        except KeyError:
-            gps = fd[group]["gps0"][:]
-        attrs = dict(fd[group]["rx0"].attrs.items())
+            self.rx0 = self.fd[group]["rx0"]
+            try:
+                self.gps0 = self.fd[group]["ppp0"]
+            except KeyError:
+                self.gps0 = self.fd[group]["gps0"]
+        except Exception:
+            self.fd.close()
+            raise
+
+        self.file = file
+        self.group = group
+        self.cache = {}
+
+        attrs = dict(self.rx0.attrs.items())
+
+        # Restore the data type of arrays stored in a narrower integer type
+        self.dtype = np.dtype(attrs.pop("dtype", self.rx0.dtype))
+
+        self.attrs = translate_attrs(attrs, self.rx0.shape[0])
+        self.utc = translate_gps(self.gps0.dtype)
+
+        self.dist0 = None
+        if "dist0" in self.fd[group]:
+            self.dist0 = self.fd[group]["dist0"]
+
+        # Only use an index that was built from the positions in use and covers every
+        # trace, files still being written by ghog_mkh5 --follow have none
+        self.index = None
+        if "index0" in self.fd[group]:
+            index0 = self.fd[group]["index0"]
+            if index0.attrs.get("gps") == os.path.basename(self.gps0.name):
+                index = index0[:]
+                if len(index) > 0 and index["stop"][-1] == len(self.gps0):
+                    self.index = index
+
+    @property
+    def shape(self):
+        """Shape of the 2D data array.
+
+        Only traces with positions are counted. ghog_mkh5 --follow writes positions
+        first, so a file still being written can have positions for traces it hasn't
+        written yet.
+        """
+        return (self.rx0.shape[0], min(self.rx0.shape[1], len(self.gps0)))
+
+    def __getitem__(self, key):
+        if type(key) == str:
+            if key == "attrs":
+                return self.attrs
+            if key not in list(iter(self)):
+                raise KeyError(key)
+            if key not in self.cache:
+                if key == "rx":
+                    self.cache[key] = self.read_rx(slice(None))
+                elif key == "gps":
+                    self.cache[key] = self.read_gps(slice(None))
+                else:
+                    self.cache[key] = self.dist0[:]
+            return self.cache[key]
+
+        return self.read(key)
+
+    def __iter__(self):
+        keys = ["rx", "gps", "attrs"]
+        if self.dist0 is not None:
+            keys.append("dist")
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the HDF5 file."""
+        self.fd.close()
+
+    def read_rx(self, traces, dtype=None):
+        """Read traces of the 2D data array.
+
+        Args:
+            traces: Trace index or slice.
+            dtype: Data type to read as, converted while reading (default = None : as
+                saved).
+
+        Returns:
+            2D data array of the selected traces.
+        """
+        if dtype is not None:
+            return self.rx0.astype(dtype)[:, trace_slice(traces, self.shape[1])]
+
+        rx = self.rx0[:, trace_slice(traces, self.shape[1])]
+        return rx.astype(self.dtype, copy=False)
+
+    def read_gps(self, traces):
+        """Read positions and times of traces.
+
+        Args:
+            traces: Trace index or slice.
+
+        Returns:
+            numpy structured array with per-column positions and times of the selected
+            traces.
+        """
+        gps = self.gps0[trace_slice(traces, self.shape[1])]
+
+        if self.utc is not None:
+            gpsrefmt = np.empty(len(gps), dtype=ghog.gps.GPS_DTYPE)
+            for k in ["lon", "lat", "hgt"]:
+                gpsrefmt[k] = gps[k]
+            gpsrefmt["utc"] = gps[self.utc]
+            gps = gpsrefmt
+
+        return gps
 
+    def select(self, traces=None, time=None, bbox=None):
+        """Find the traces matching selectors, using the group index if there is one.
+
+        Args:
+            traces: Trace index or slice (default = all traces).
+            time: Time window (t0, t1), inclusive, anything that casts to numpy
+                datetime64 (default = no time selection).
+            bbox: Bounding box (lon0, lat0, lon1, lat1), inclusive (default = no
+                position selection).
+
+        Returns:
+            Slice of traces matching every selector. Time and bounding box selections span
+            the first to the last trace inside them so traces stay contiguous.
+        """
+        start = 0
+        stop = self.shape[1]
+
+        if traces is not None:
+            start, stop, step = trace_slice(traces).indices(self.shape[1])
+            if step != 1:
+                raise ValueError("traces must be a contiguous slice.")
+
+        if time is not None:
+            if len(time) != 2:
+                raise ValueError("time is not a (t0, t1) pair.")
+            t0, t1 = [np.datetime64(t, "us").astype(np.int64) for t in time]
+            if t0 > t1:
+                raise ValueError("time window ends before it starts.")
+
+            def inside(gps):
+                t = ghog.gps.gps_times(gps).astype(np.int64)
+                return (t >= t0) & (t <= t1)
+
+            blocks = None
+            if self.index is not None:
+                tmin = self.index["tmin"]
+                tmax = self.index["tmax"]
+                if np.all(np.diff(tmin) >= 0) and np.all(np.diff(tmax) >= 0):
+                    # Block time extents are sorted, as they are unless the clock
+                    # jumped back, so the overlapping blocks are a contiguous run
+                    lo = np.searchsorted(tmax, t0, side="left")
+                    hi = np.searchsorted(tmin, t1, side="right")
+                    blocks = np.arange(lo, max(lo, hi))
+                else:
+                    blocks = np.flatnonzero((tmax >= t0) & (tmin <= t1))
+
+            a, b = self.span(blocks, inside)
+            start = max(start, a)
+            stop = min(stop, b)
+
+        if bbox is not None:
+            if len(bbox) != 4:
+                raise ValueError("bbox is not a (lon0, lat0, lon1, lat1) tuple.")
+            lon0, lat0, lon1, lat1 = bbox
+            if lon0 > lon1 or lat0 > lat1:
+                raise ValueError("bbox minimum exceeds maximum.")
+
+            def inside(gps):
+                return (
+                    (gps["lon"] >= lon0)
+                    & (gps["lon"] <= lon1)
+                    & (gps["lat"] >= lat0)
+                    & (gps["lat"] <= lat1)
+                )
+
+            blocks = None
+            if self.index is not None:
+                blocks = np.flatnonzero(
+                    (self.index["lonmax"] >= lon0)
+                    & (self.index["lonmin"] <= lon1)
+                    & (self.index["latmax"] >= lat0)
+                    & (self.index["latmin"] <= lat1)
+                )
+
+            a, b = self.span(blocks, inside)
+            start = max(start, a)
+            stop = min(stop, b)
+
+        return slice(start, max(start, stop))
+
+    def span(self, blocks, inside):
+        # Range of traces from the first to the last one inside a selection. Given the
+        # index blocks that may hold some, in order, positions are read a block at a
+        # time from each end until one inside is found. Without an index all positions
+        # are read.
+        if blocks is None:
+            hit = np.flatnonzero(inside(self.read_gps(slice(None))))
+            if len(hit) == 0:
+                return 0, 0
+            return int(hit[0]), int(hit[-1]) + 1
+
+        def ends(i):
+            # First and last trace inside a block, None if there are none
+            a = int(self.index["start"][i])
+            b = int(self.index["stop"][i])
+            hit = np.flatnonzero(inside(self.read_gps(slice(a, b))))
+            if len(hit) == 0:
+                return None
+            return a + int(hit[0]), a + int(hit[-1]) + 1
+
+        first = next((e for e in map(ends, blocks) if e is not None), None)
+        if first is None:
+            return 0, 0
+
+        # The block holding the first trace inside ends this search at the latest
+        last = next(e for e in map(ends, blocks[::-1]) if e is not None)
+
+        return first[0], last[1]
+
+    def read(self, traces=slice(None), dtype=None):
+        """Read traces into memory.
+
+        Args:
+            traces: Trace index or slice (default = all traces).
+            dtype: Data type to read the 2D data array as (default = None : as saved).
+
+        Returns:
+            GhogData containing the 2D data array (rx), numpy structured array with
+            per-column positions and times (gps), and data attributes (attrs). Also
+            along-track distance (dist) if the group has it.
+        """
+        dist = None
+        if self.dist0 is not None:
+            dist = self.dist0[trace_slice(traces)]
+
+        return ghog.data.GhogData(
+            self.read_rx(traces, dtype), self.read_gps(traces), dict(self.attrs), dist
+        )
+
+
+def trace_slice(traces, ntrace=None):
+    # Single traces are read as a slice so rx stays two dimensional. With ntrace the
+    # slice is bounded to the first ntrace traces.
+    if isinstance(traces, (int, np.integer)):
+        if traces == -1:
+            traces = slice(-1, None)
+        else:
+            traces = slice(traces, traces + 1)
+
+    if not isinstance(traces, slice):
+        raise TypeError("traces is not an integer or slice.")
+
+    if ntrace is not None:
+        return slice(*traces.indices(ntrace))
+
+    return traces
+
+
+def translate_attrs(attrs, spt):
     # Do some attribute translation/addition if necessary
     # handles old files
     expected_keys = ["fs", "pre_trig", "prf", "spt", "stack", "trig"]
@@ -50,41 +337,216 @@ def load(file, group="raw"):
             elif key == "prf":
                 attrs["prf"] = 0
             elif key == "spt":
-                attrs["spt"] = rx.shape[0]
-
-    # Rearrange gps data type if necessary
-    # also for handling old files
-    gpst = [("lon", "<f8"), ("lat", "<f8"), ("hgt", "<f8"), ("utc", "S26")]
-    if gps.dtype != gpst:
-        fields = gps.dtype.names
-        if (
-            "lon" in fields
-            and "lat" in fields
-            and "hgt" in fields
-            and ("utc" in fields or "time" in fields)
-        ):
-            warnings.warn(
-                "Unexpected GNSS datatype, attempting to reformat.",
-                stacklevel=2,
-            )
-            if "utc" in fields:
-                utc = "utc"
-            else:
-                utc = "time"
-            gpsrefmt = list(zip(gps["lon"], gps["lat"], gps["hgt"], gps[utc]))
-            gps = np.array(gpsrefmt, dtype=gpst)
+                attrs["spt"] = spt
+
+    return attrs
+
+
+def translate_gps(dtype):
+    # Time field of gps datasets that have to be rearranged to the expected data type,
+    # None if no rearranging is necessary. Also for handling old files.
+    if dtype == ghog.gps.GPS_DTYPE or dtype == ghog.gps.GPS_EPOCH_DTYPE:
+        return None
+
+    fields = dtype.names
+    if (
+        "lon" in fields
+        and "lat" in fields
+        and "hgt" in fields
+        and ("utc" in fields or "time" in fields)
+    ):
+        warnings.warn(
+            "Unexpected GNSS datatype, attempting to reformat.",
+            stacklevel=4,
+        )
+        if "utc" in fields:
+            return "utc"
+        else:
+            return "time"
 
-    return {"rx": rx, "gps": gps, "attrs": attrs}
+    return None
 
 
-def save(file, data, group="proc", overwrite=False):
+def open(file, group="raw"):
+    """Open a group of a Groundhog HDF5 file to be read on demand.
+
+    Args:
+        file: Groundhog HDF5 data file.
+        group: Group in the HDF5 file to open (default = "raw").
+
+    Returns:
+        LazyGroup backed by the HDF5 datasets. Index it with traces to read them, or
+        pass it to processing functions in place of a data dictionary.
+    """
+    return LazyGroup(file, group)
+
+
+def load(file, group="raw", traces=None, time=None, bbox=None, dtype=None):
+    """Load a group from a Groundhog HDF5 file into memory.
+
+    Args:
+        file: Groundhog HDF5 data file.
+        group: Group in the HDF5 file to load (default = "raw").
+        traces: Trace index or slice to load (default = all traces).
+        time: Time window (t0, t1) to load, inclusive, anything that casts to numpy
+            datetime64 (default = no time selection).
+        bbox: Bounding box (lon0, lat0, lon1, lat1) to load, inclusive (default = no
+            position selection).
+        dtype: Data type to load the 2D data array as, converted while reading, e.g.
+            ghog.config.dtype to process in place (default = None : as saved).
+
+    Returns:
+        GhogData containing the 2D data array (rx), numpy structured array with per-column
+        positions and times (gps), and data attributes (attrs). Also along-track distance
+        (dist) if the group has it. Time and bounding box selections load the first to
+        the last trace inside them.
+    """
+    with LazyGroup(file, group) as lazy:
+        return lazy.read(lazy.select(traces, time, bbox), dtype)
+
+
+def build_index(gps, ntrace=INDEX_TRACES):
+    """Build a time and position index of traces.
+
+    Args:
+        gps: numpy structured array with per-column positions and times.
+        ntrace: Traces per index block (default = INDEX_TRACES).
+
+    Returns:
+        numpy structured array with the range of traces (start, stop), epoch time extents
+        in microseconds (tmin, tmax) and position extents (lonmin, lonmax, latmin,
+        latmax) of each block of traces.
+    """
+    start = np.arange(0, len(gps), ntrace)
+    times = ghog.gps.gps_times(gps).astype(np.int64)
+
+    index = np.empty(len(start), dtype=INDEX_DTYPE)
+    index["start"] = start
+    index["stop"] = np.append(start[1:], len(gps))
+    if len(gps) > 0:
+        for name, v in [("t", times), ("lon", gps["lon"]), ("lat", gps["lat"])]:
+            index[name + "min"] = np.minimum.reduceat(v, start)
+            index[name + "max"] = np.maximum.reduceat(v, start)
+
+    return index
+
+
+def write_index(group, gps, name="gps0"):
+    """Write the time and position index of a group in an open HDF5 file.
+
+    Args:
+        group: h5py group.
+        gps: numpy structured array with per-column positions and times.
+        name: Name of the dataset the positions are from (default = "gps0").
+    """
+    if "index0" in group:
+        del group["index0"]
+
+    index0 = group.create_dataset("index0", data=build_index(gps))
+    index0.attrs["gps"] = name
+
+
+def write_distance(group, gps, dist=None, **kwargs):
+    """Write the along-track distance of a group in an open HDF5 file.
+
+    Args:
+        group: h5py group containing rx0.
+        gps: numpy structured array with per-column positions and times.
+        dist: Along-track distance of gps, computed if None (default = None).
+        kwargs: Keywords for h5py create_dataset.
+    """
+    if dist is None:
+        dist = ghog.geodesy.track_distance(gps)
+
+    if "dist0" in group:
+        del group["dist0"]
+
+    group.create_dataset("dist0", data=dist, **kwargs)
+    group["rx0"].attrs["dist_key"] = ghog.geodesy.track_key(gps)
+
+
+def narrow_dtype(rx):
+    """Find the narrowest integer type that holds the range of a data array.
+
+    Args:
+        rx: Data array.
+
+    Returns:
+        Narrowest signed integer type holding every value of rx, or the type of rx if it
+        is not an integer array or no narrower type holds it.
+    """
+    if rx.dtype.kind not in "iu" or rx.size == 0:
+        return rx.dtype
+
+    lo = rx.min()
+    hi = rx.max()
+    for dtype in [np.int8, np.int16, np.int32]:
+        info = np.iinfo(dtype)
+        if np.dtype(dtype).itemsize >= rx.dtype.itemsize:
+            break
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(dtype)
+
+    return rx.dtype
+
+
+def chunk_traces(spt, itemsize):
+    """Number of traces in a chunk of about CHUNK_BYTES.
+
+    Args:
+        spt: Samples per trace.
+        itemsize: Bytes per sample.
+
+    Returns:
+        Traces per chunk.
+    """
+    return max(1, CHUNK_BYTES // (spt * itemsize))
+
+
+def filters(compression):
+    """HDF5 dataset creation keywords for a compression filter.
+
+    Args:
+        compression: Compression filter, one of None, "gzip", or "lzf". Compressed
+        datasets are byte shuffled first.
+
+    Returns:
+        Dictionary of keywords for h5py create_dataset, empty if compression is None.
+    """
+    if compression not in COMPRESSION:
+        raise ValueError("compression must be one of %s." % COMPRESSION)
+
+    if compression is None:
+        return {}
+
+    return {"compression": compression, "shuffle": True}
+
+
+def save(
+    file,
+    data,
+    group="proc",
+    overwrite=False,
+    compression=None,
+    compact=False,
+    dtype=None,
+):
     """Save a group to a Groundhog HDF5 file.
 
+    Along-track distance is saved with the group, so it is not recomputed after
+    loading.
+
     Args:
       file: Groundhog HDF5 data file.
       data: Groundhog data dictionary (rx, gps, attrs).
       group: Group to save to in the HDF5 file (default = "proc").
       overwrite: Overwrite a group if it already exists in an HDF5 file (default = False).
+      compression: Compression filter, one of None, "gzip", or "lzf". Compressed
+        datasets are chunked along traces (default = None).
+      compact: Store integer data in the narrowest integer type that holds it, restored
+        by load (default = False).
+      dtype: Data type to store the 2D data array as, e.g. ghog.config.dtype (default
+        = None : as it is).
     """
     ghog.checks.check_data(data)
 
@@ -97,6 +559,28 @@ def save(file, data, group="proc", overwrite=False):
     if type(overwrite) != bool:
         raise TypeError("overwrite is not a boolean.")
 
+    if type(compact) != bool:
+        raise TypeError("compact is not a boolean.")
+
+    rx = data["rx"]
+    gps = data["gps"]
+
+    rx_kw = filters(compression)
+    gps_kw = filters(compression)
+
+    # Only narrowed integer data records its type to be restored by load
+    narrowed = False
+    if dtype is not None:
+        rx = rx.astype(dtype, copy=False)
+    elif compact:
+        rx = rx.astype(narrow_dtype(rx), copy=False)
+        narrowed = rx.dtype != data["rx"].dtype
+
+    if compression is not None and rx.size > 0:
+        ntrace = min(rx.shape[1], chunk_traces(rx.shape[0], rx.dtype.itemsize))
+        rx_kw["chunks"] = (rx.shape[0], ntrace)
+        gps_kw["chunks"] = (ntrace,)
+
     with h5py.File(file, mode="a") as fd:
         if group in fd:
             if not overwrite:
@@ -109,7 +593,11 @@ def save(file, data, group="proc", overwrite=False):
 
         # Build group/datasets
         fd.create_group(group)
-        fd[group].create_dataset("rx0", data=data["rx"])
-        fd[group].create_dataset("gps0", data=data["gps"])
+        fd[group].create_dataset("rx0", data=rx, **rx_kw)
+        fd[group].create_dataset("gps0", data=gps, **gps_kw)
+        write_index(fd[group], gps)
         for k, v in data["attrs"].items():
             fd[group]["rx0"].attrs[k] = v
+        if narrowed:
+            fd[group]["rx0"].attrs["dtype"] = data["rx"].dtype.str
+        write_distance(fd[group], gps, ghog.geodesy.distance(data), **gps_kw)
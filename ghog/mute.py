@@ -1,25 +1,33 @@
 import numpy as np
 
 import ghog.checks
+import ghog.config
+import ghog.data
 
 
-def mute(data, indices, axis=0):
+def mute(data, indices, axis=0, inplace=False):
     """Apply a mute to rows or columns of the data.
 
     Args:
         data: Groundhog data dictionary (rx, gps, attrs).
         indices: Indices of the rows or columns to mute.
         axis: Axis on which to apply the mute (default = 0 : mute columns).
+        inplace: Mute rx in place (default = False). Otherwise the muted array is
+            ghog.config.dtype.
 
     Returns:
-        Dictionary containing the muted 2D data array (rx), numpy structured array with
+        GhogData containing the muted 2D data array (rx), numpy structured array with
         per-column positions and times (gps), and data attributes (attrs).
     """
     if type(indices) != list and type(indices) != tuple and type(indices) != np.ndarray:
         raise TypeError("indices must be a list, tuple, or numpy ndarray")
     
     # TODO: add tapering here
-    rxmute = np.copy(data["rx"])
+    if inplace:
+        ghog.checks.check_inplace(data["rx"], floating=False)
+        rxmute = data["rx"]
+    else:
+        rxmute = data["rx"].astype(ghog.config.float_type())
 
     for i in indices:
         if(axis == 0):
@@ -27,4 +35,4 @@ def mute(data, indices, axis=0):
         elif(axis == 1):
             rxmute[i, :] = 0
 
-    return {"rx": rxmute, "gps": np.copy(data["gps"]), "attrs": dict(data["attrs"])}
+    return ghog.data.GhogData(rxmute, data["gps"], data["attrs"], data.get("dist"))
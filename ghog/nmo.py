@@ -1,25 +1,35 @@
 # Normal move out correction
+import functools
+
 import numpy as np
 
 import ghog.checks
+import ghog.config
 import ghog.constants
+import ghog.data
 
 
-def nmo(data, sep, pnmo=3.15):
+def nmo(data, sep, pnmo=3.15, inplace=False):
     """Normal move out and trigger delay correction.
 
+    Data is corrected in ghog.config.dtype, or in the type of rx when it is floating
+    point and corrected in place.
+
     Args:
         data: Groundhog data dictionary (rx, gps, attrs).
         sep: Separation between source and receiver in meters.
         pnmo: Move out relative permittivity (default = 3.15).
+        inplace: Correct rx in place, a block of traces at a time. The corrected traces
+            are the leading rows of rx, if they are longer than it they are written to a
+            new array instead (default = False).
 
     Returns:
-        Dictionary containing the NMO corrected 2D data array (rx), numpy structured array with
+        GhogData containing the NMO corrected 2D data array (rx), numpy structured array with
         per-column positions and times (gps), and data attributes (attrs).
     """
     ghog.checks.check_data(data)
 
-    rx = np.copy(data["rx"])
+    rx = data["rx"]
     attrs = dict(data["attrs"])
 
     if pnmo < 1:
@@ -28,13 +38,62 @@ def nmo(data, sep, pnmo=3.15):
     if sep < 0:
         raise ValueError("sep cannot be negative.")
 
+    nsamp, i0, i1, num, den = nmo_weights(
+        rx.shape[0], attrs["fs"], sep, pnmo, attrs["pre_trig"]
+    )
+
+    if inplace and np.issubdtype(rx.dtype, np.floating):
+        dtype = rx.dtype
+    else:
+        dtype = ghog.config.float_type()
+
+    def correct(traces):
+        # Gather both interpolation end points of every output sample for all traces
+        # at once. Samples from before the trigger delay are zero.
+        x = rx[:, traces]
+        a = np.take(x, np.maximum(i0, 0), axis=0).astype(dtype, copy=False)
+        a[i0 < 0] = 0
+        b = np.take(x, np.maximum(i1, 0), axis=0).astype(dtype, copy=False)
+        b[i1 < 0] = 0
+
+        # Same arithmetic as np.interp, slope times offset plus left value
+        b -= a
+        b /= den[:, np.newaxis]
+        b *= num[:, np.newaxis]
+        b += a
+        return b
+
+    if inplace:
+        ghog.checks.check_inplace(rx, floating=False)
+
+    # The trigger delay can add more samples than the pre-trigger samples trimmed
+    if inplace and len(i0) <= rx.shape[0]:
+        # Each block of traces is corrected before it's written back
+        ntrace = max(1, ghog.config.block_bytes // (16 * len(i0)))
+        for start in range(0, rx.shape[1], ntrace):
+            traces = slice(start, start + ntrace)
+            rx[: len(i0), traces] = correct(traces)
+        rxnmo = rx[: len(i0)]
+    else:
+        rxnmo = correct(slice(None))
+
+    attrs["spt"] = attrs["spt"] - attrs["pre_trig"] + nsamp
+    attrs["pre_trig"] = 0
+
+    return ghog.data.GhogData(rxnmo, data["gps"], attrs, data.get("dist"))
+
+
+@functools.lru_cache(maxsize=32)
+def nmo_weights(nt, fs, sep, pnmo, pre_trig):
+    # Trigger delay in samples and linear interpolation weights of the NMO correction,
+    # applied as rx[i0] + (rx[i1] - rx[i0]) / den * num. Indices are into the input
+    # traces, with the trigger delay inserted and pre-trigger samples trimmed. Negative
+    # indices fall before the trigger delay. Cached since they only depend on geometry.
+
     ## Add in trigger delay
     tdelay = sep / ghog.constants.c
-    nsamp = np.ceil(tdelay * attrs["fs"]).astype(np.int32)
-
-    rx = np.pad(rx, ((0, nsamp), (0, 0)), mode="constant", constant_values=0)
-    rx = np.roll(rx, nsamp, axis=0)
-    dt = 1.0 / attrs["fs"]
+    nsamp = np.ceil(tdelay * fs).astype(np.int32)
+    dt = 1.0 / fs
 
     # Freq domain makes weird artifacts at end of traces
     cmt = """
@@ -50,16 +109,27 @@ def nmo(data, sep, pnmo=3.15):
     rx = rx[epad:-epad, :]"""
 
     # trim pre-trigger samples
-    rx = rx[attrs["pre_trig"] :, :]
-    attrs["spt"] = attrs["spt"] - attrs["pre_trig"] + nsamp
-    attrs["pre_trig"] = 0
+    n = nt + nsamp - pre_trig
 
     ## NMO correction
     vnmo = ghog.constants.c / np.sqrt(pnmo)
-    rxnmo = np.zeros_like(rx)
-    t0 = np.arange(rx.shape[0]) * dt
+    t0 = np.arange(n) * dt
     t = np.sqrt(t0**2 + sep**2 / vnmo**2)
-    for i in range(rx.shape[1]):
-        rxnmo[:, i] = np.interp(t, t0, rx[:, i])
 
-    return {"rx": rxnmo, "gps": np.copy(data["gps"]), "attrs": attrs}
+    # Interval of t0 containing each t, the last sample past the end
+    j = np.searchsorted(t0, t, side="right") - 1
+    end = j >= n - 1
+    j[end] = n - 1
+    k = np.minimum(j + 1, n - 1)
+
+    num = t - t0[j]
+    num[end] = 0
+    den = t0[k] - t0[j]
+    den[end] = 1
+
+    shift = pre_trig - nsamp
+    weights = (nsamp, j + shift, k + shift, num, den)
+    for w in weights[1:]:
+        w.setflags(write=False)
+
+    return weights
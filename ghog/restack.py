@@ -1,12 +1,15 @@
 # Restack traces to constant distance intervals
 import numpy as np
-import pyproj
 import matplotlib.pyplot as plt
 
 import ghog.checks
+import ghog.config
+import ghog.data
+import ghog.geodesy
+import ghog.gps
 
 
-def restack(data, interval, dcut=0):
+def restack(data, interval, dcut=0, inplace=False):
     """Restack traces to constant distance intervals.
 
     Args:
@@ -15,9 +18,12 @@ def restack(data, interval, dcut=0):
             all original distance intervals in rx (this function does not interpolate).
         dcut: Cutoff threshold for no motion between two traces. Distances below this threshold
             are set to zero for the purpose of restacking. Helpful for noisy position data (default = 0).
+        inplace: Restack into the leading columns of rx, a block at a time. rx must be
+            floating point and every restacked trace must have a raw trace in it
+            (default = False). Otherwise the restacked array is ghog.config.dtype.
 
     Returns:
-        Dictionary containing the restacked 2D data array (rx), numpy structured array with per-column
+        GhogData containing the restacked 2D data array (rx), numpy structured array with per-column
         positions and times (gps), and data attributes (attrs).
     """
     ghog.checks.check_data(data)
@@ -32,14 +38,17 @@ def restack(data, interval, dcut=0):
     if dcut < 0:
         raise ValueError("dcut cannot be negative.")
 
-    xform = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:4978")
-    x, y, z = xform.transform(gps["lat"], gps["lon"], gps["hgt"])
-    steps = np.sqrt(np.diff(x) ** 2 + np.diff(y) ** 2 + np.diff(z) ** 2)
-    steps[steps < dcut] = 0
-    dist = np.append(
-        0,
-        np.cumsum(steps),
-    )
+    if inplace:
+        ghog.checks.check_inplace(rx)
+
+    dist = ghog.geodesy.distance(data)
+    steps = np.diff(dist)
+    if dcut > 0:
+        steps[steps < dcut] = 0
+        dist = np.append(
+            0,
+            np.cumsum(steps),
+        )
 
     if np.any(steps > interval):
         raise ValueError(
@@ -49,25 +58,48 @@ def restack(data, interval, dcut=0):
 
     nrstk = np.ceil(dist[-1] / interval).astype(np.uint32)
 
-    rx_rstk = np.zeros((rx.shape[0], nrstk), dtype=np.float64)
     gps_rstk = np.empty(nrstk, gps.dtype)
 
-    time = np.array(list(map(np.datetime64, gps["utc"])))
+    time = ghog.gps.gps_times(gps)
     epoch = time[0]
     time_sse = (time - epoch).astype(np.int64)
-    
+
     # Generate restacked coordinates and times
     dist_restack = np.arange(0, np.sum(steps), interval)
 
     for col in ["lon", "lat", "hgt"]:
         gps_rstk[col] = np.interp(dist_restack, dist, gps[col])
-    gps_rstk["utc"] = np.datetime_as_string(epoch + np.interp(dist_restack, dist, time_sse).astype('<m8[us]'))
-    
-    # Restack data
-    for i in range(nrstk):
-        mask = np.logical_and(dist >= interval * i, dist < interval * (i + 1))
-        rx_rstk[:, i] = np.mean(rx[:, mask], axis=1)
+    time_rstk = epoch + np.interp(dist_restack, dist, time_sse).astype("<m8[us]")
+    gps_rstk["utc"] = np.datetime_as_string(time_rstk)
+    if "epoch" in gps.dtype.names:
+        gps_rstk["epoch"] = time_rstk.astype(np.int64)
+
+    # Restack data. Distance never decreases, so each bin is a contiguous run of
+    # traces and the bins can be summed in one pass. Empty bins are NaN.
+    edges = np.searchsorted(dist, interval * np.arange(nrstk + 1), side="left")
+    counts = np.diff(edges)
+    full = counts > 0
+    if inplace:
+        # Each restacked trace is at or before the first raw trace in it, so a block
+        # can be written over raw traces the remaining blocks don't use
+        if not np.all(full):
+            raise ValueError("Cannot restack in place with empty restacking intervals.")
+
+        nbin = max(1, ghog.config.block_bytes // (8 * rx.shape[0]))
+        for b0 in range(0, nrstk, nbin):
+            b1 = min(b0 + nbin, nrstk)
+            sums = np.add.reduceat(
+                rx[:, edges[b0] : edges[b1]], edges[b0:b1] - edges[b0], axis=1
+            )
+            rx[:, b0:b1] = sums / counts[b0:b1]
+        rx_rstk = rx[:, :nrstk]
+    else:
+        rx_rstk = np.zeros((rx.shape[0], nrstk), dtype=ghog.config.float_type())
+        if np.any(full):
+            sums = np.add.reduceat(rx[:, : edges[-1]], edges[:-1][full], axis=1)
+            rx_rstk[:, full] = sums / counts[full]
+        rx_rstk[:, ~full] = np.nan
 
     attrs["stack_interval"] = interval
 
-    return {"rx": rx_rstk, "gps": gps_rstk, "attrs": attrs}
+    return ghog.data.GhogData(rx_rstk, gps_rstk, attrs)
@@ -1,11 +1,56 @@
 # Stolt migration
+import collections
+import concurrent.futures
+import threading
+import tracemalloc
+import warnings
+
 import numpy as np
+import scipy.fft
 import scipy.signal
 
 import ghog.checks
+import ghog.config
+import ghog.constants
+import ghog.data
+
+WINDOWS = ["box", "hann", "tukey"]  # taper window shapes
+
+BLOCK_SAMPLES = 2**16  # spectrum samples interpolated at once, sized to stay in cache
+
+METRICS = ["entropy", "kurtosis"]  # focusing metrics of a permittivity scan
+
+# Interpolation kernels and their default number of points
+KERNELS = {"linear": 2, "lagrange": 4, "sinc": 8}
 
+# Real and complex types of each migration precision
+PRECISION = {
+    "double": (np.float64, np.complex128),
+    "single": (np.float32, np.complex64),
+}
 
-def stolt(data, pmig=3.15, ntaper=32, px=None, pt=None):
+# Remap tables of recently migrated grids, by grid, and how often they were found
+tables = collections.OrderedDict()
+tables_lock = threading.Lock()
+cache_stats = {"hits": 0, "misses": 0}
+
+
+def stolt(
+    data,
+    pmig=3.15,
+    ntaper=32,
+    px=None,
+    pt=None,
+    window="box",
+    precision=None,
+    max_memory=None,
+    kernel="linear",
+    taps=None,
+    workers=None,
+    tile=None,
+    inplace=False,
+    verbose=False,
+):
     """Perform Stolt migration.
 
     This function performs Stolt migration.
@@ -16,9 +61,32 @@ def stolt(data, pmig=3.15, ntaper=32, px=None, pt=None):
         ntaper: Taper width in pixels, applied to all sides of image (default = 32).
         pt: Zero padding along time axis (default = 10x length of time axis).
         px: Zero padding along distance axis (default = 1x length of distance axis).
+        window: Taper window shape, valid options are ["box", "hann", "tukey"]. "box" smooths
+            the image edges with an ntaper wide box, "hann" is a Hann window across the
+            whole image and ignores ntaper, and "tukey" has ntaper wide cosine ramps
+            (default = "box").
+        precision: Floating point precision of the migration, valid options are ["double",
+            "single"]. Single precision halves memory use (default = None : "single" if
+            ghog.config.dtype is float32, otherwise "double").
+        max_memory: Approximate memory budget in bytes. Default padding is reduced, time
+            axis first, to fit it, and the remap table is only cached if it fits too
+            (default = None : no budget).
+        kernel: Interpolation kernel from frequency to vertical wavenumber, valid options
+            are ["linear", "lagrange", "sinc"] (default = "linear").
+        taps: Number of points of the lagrange or sinc kernel (default = 4 for lagrange, 8
+            for sinc).
+        workers: Number of threads for FFTs and interpolation (default = None :
+            ghog.config.workers).
+        tile: Migrate overlapping windows of this many traces, in parallel, and blend them
+            together. "auto" sizes windows from the migration aperture. Windows narrower
+            than four apertures are widened to that, with a warning. Padding and
+            max_memory then apply per window (default = None : whole image at once).
+        inplace: Write the migrated image into rx, it must be floating point (default =
+            False).
+        verbose: Print the padded image size and the peak memory used (default = False).
 
     Returns:
-        Dictionary containing the migrated 2D data array (rx), numpy structured array with per-column
+        GhogData containing the migrated 2D data array (rx), numpy structured array with per-column
         positions and times (gps), and data attributes (attrs)
     """
     ghog.checks.check_data(data)
@@ -26,61 +94,643 @@ def stolt(data, pmig=3.15, ntaper=32, px=None, pt=None):
     rx = data["rx"]
     attrs = dict(data["attrs"])
 
-    ## Taper
-    taper = np.ones_like(rx)
-    taper[: ntaper // 2, :] = 0
-    taper[-ntaper // 2 :, :] = 0
-    taper[:, : ntaper // 2] = 0
-    taper[:, -ntaper // 2 :] = 0
-    taper = scipy.signal.convolve2d(
-        taper, np.ones((ntaper, ntaper)) / (ntaper**2), mode="same"
+    precision, taps, workers = check_options(
+        window, precision, max_memory, kernel, taps, workers
     )
-    rx *= taper
 
-    ## Pad
+    if inplace:
+        ghog.checks.check_inplace(rx)
+
     nt = rx.shape[0]
     nx = rx.shape[1]
-    if pt is None:
-        pt = 10 * nt
+    cmig = ghog.constants.c / np.sqrt(pmig)
+    dt = 1.0 / attrs["fs"]
+    dx = attrs["stack_interval"]
+
+    ## Windows
+    # Windows overlap by twice the aperture, they're at least twice that wide so the
+    # overlap isn't clipped
+    width = aperture(nt, dt, dx, cmig)
+    if tile is None:
+        tile = nx
+    elif tile == "auto":
+        tile = 4 * 2 * width
+    elif isinstance(tile, str) or not isinstance(tile, (int, np.integer)):
+        raise ValueError(
+            'Invalid tile argument: %s. tile must be None, "auto" or a number of traces.'
+            % (tile,)
+        )
+    elif tile < 2:
+        raise ValueError("tile must be at least two traces.")
+    elif tile < 2 * 2 * width:
+        warnings.warn(
+            "tile of %d traces is narrower than four migration apertures, widening it "
+            "to %d traces." % (tile, 2 * 2 * width)
+        )
+        tile = 2 * 2 * width
+
+    tile = min(tile, nx)
+    overlap = min(2 * width, tile // 2)
+    starts = tile_starts(nx, tile, overlap)
+    nrun = min(workers, len(starts))
+
+    if max_memory is not None:
+        max_memory = max_memory / nrun
+
+    mt, mx = padded_shape(nt, tile, pt, px, precision, max_memory)
+    spare = spare_memory(mt, mx, precision, max_memory)
 
-    if px is None:
-        px = 1 * nx
+    if verbose:
+        if len(starts) == 1:
+            print("Migrating %d x %d image padded to %d x %d" % (nt, nx, mt, mx))
+        else:
+            print(
+                "Migrating %d x %d image in %d windows of %d traces overlapping by %d, "
+                "each padded to %d x %d" % (nt, nx, len(starts), tile, overlap, mt, mx)
+            )
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        mem0 = tracemalloc.get_traced_memory()[0]
 
-    rx = np.pad(rx, ((0, pt), (0, px)), mode="constant", constant_values=0)
+        # Peak of this migration only if something else was already tracing,
+        # reset_peak needs Python 3.9
+        if tracing and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
 
     ## Migrate
-    cmig = ghog.constants.c / np.sqrt(pmig)
+    # Tapers are for the whole image, windows take their slice of the distance taper
+    ttaper = taper(nt, ntaper, window)
+    xtaper = taper(nx, ntaper, window)
+
+    def run(start, out=None):
+        stop = start + tile
+        return migrate_image(
+            rx[:, start:stop],
+            ttaper,
+            xtaper[start:stop],
+            mt,
+            mx,
+            dt,
+            dx,
+            cmig,
+            precision,
+            kernel,
+            taps,
+            workers if nrun == 1 else 1,
+            out,
+            spare,
+        )
+
+    if len(starts) == 1:
+        rxmig = run(0, rx if inplace else None)
+    else:
+        # Overlap-add, weighted by ramps across the overlaps. Windows are run in
+        # batches so only one per thread is held at a time.
+        rxmig = np.zeros((nt, nx), dtype=PRECISION[precision][0])
+        wsum = np.zeros(nx)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nrun) as pool:
+            for i in range(0, len(starts), nrun):
+                batch = starts[i : i + nrun]
+                for start, image in zip(batch, pool.map(run, batch)):
+                    w = blend(tile, overlap, start > 0, start + tile < nx)
+                    image *= w[np.newaxis, :]
+                    rxmig[:, start : start + tile] += image
+                    wsum[start : start + tile] += w
+                    del image
+        rxmig /= wsum[np.newaxis, :]
+
+        # Windows overlap, so rx is only overwritten once they're all migrated
+        if inplace:
+            rx[...] = rxmig
+            rxmig = rx
+
+    if verbose:
+        peak = tracemalloc.get_traced_memory()[1] - mem0
+        if not tracing:
+            tracemalloc.stop()
+        print("Peak migration memory %.1f MB" % (peak / 1e6))
+
+    attrs["vmig"] = cmig
+
+    return ghog.data.GhogData(rxmig, data["gps"], attrs, data.get("dist"))
+
+
+def stolt_scan(
+    data,
+    pmig_values,
+    metric=None,
+    nwin=None,
+    ntaper=32,
+    px=None,
+    pt=None,
+    window="box",
+    precision=None,
+    max_memory=None,
+    kernel="linear",
+    taps=None,
+    workers=None,
+):
+    """Stolt migrate with a range of permittivities.
+
+    The tapered, padded forward transform is computed once and remapped for each
+    permittivity, in parallel. Images can be reduced to a focusing metric per window of
+    traces, a sharply focused image has low entropy and high kurtosis.
+
+    Args:
+        data: Groundhog data dictionary (rx, gps, attrs).
+        pmig_values: Migration relative permittivities.
+        metric: Focusing metric, valid options are ["entropy", "kurtosis"] (default =
+            None : return migrated images).
+        nwin: Width in traces of metric windows (default = None : whole image).
+        ntaper, px, pt, window, precision, max_memory, kernel, taps: As for stolt.
+        workers: Number of threads, permittivities are migrated concurrently (default =
+            None : ghog.config.workers).
+
+    Returns:
+        List of GhogData of migrated images, one per permittivity, or with a metric a 2D
+        array of the metric for each permittivity (rows) and window (columns)
+    """
+    ghog.checks.check_data(data)
+
+    rx = data["rx"]
+    attrs = dict(data["attrs"])
+
+    precision, taps, workers = check_options(
+        window, precision, max_memory, kernel, taps, workers
+    )
+
+    if metric is not None and metric not in METRICS:
+        raise ValueError(
+            "Invalid metric argument: %s. metric must be one of: %s" % (metric, METRICS)
+        )
+
+    nt = rx.shape[0]
+    nx = rx.shape[1]
     dt = 1.0 / attrs["fs"]
     dx = attrs["stack_interval"]
 
-    # 2D fft
-    RX = np.fft.fftshift(np.fft.fft2(rx))
-    w = np.fft.fftshift(np.fft.fftfreq(rx.shape[0], d=dt))
-    kx = np.fft.fftshift(np.fft.fftfreq(rx.shape[1], d=dx))
+    if nwin is None:
+        nwin = nx
+    elif nwin < 1:
+        raise ValueError("nwin must be at least one trace.")
+
+    # The forward transform and one migrated spectrum per thread are live at once
+    nrun = min(workers, len(pmig_values))
+    if max_memory is not None:
+        max_memory = 2 * max_memory / (nrun + 1)
+
+    mt, mx = padded_shape(nt, nx, pt, px, precision, max_memory)
+    spare = spare_memory(mt, mx, precision, max_memory)
+
+    ttaper = taper(nt, ntaper, window)
+    xtaper = taper(nx, ntaper, window)
+    RX = spectrum(rx, ttaper, xtaper, mt, mx, precision, workers)
+
+    def run(pmig):
+        cmig = ghog.constants.c / np.sqrt(pmig)
+        RXmig = migrate(RX, mt, dt, dx, cmig, kernel, taps, 1, spare)
+        rxmig = inverse(RXmig, mt, nt, nx, 1)
+
+        if metric is not None:
+            return focus(rxmig, metric, nwin)
+
+        return ghog.data.GhogData(
+            rxmig, data["gps"], dict(attrs, vmig=cmig), data.get("dist")
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nrun) as pool:
+        out = list(pool.map(run, pmig_values))
+
+    if metric is not None:
+        return np.array(out)
+
+    return out
+
+
+def focus(rx, metric, nwin):
+    # Focusing metric of each window of nwin traces, the last window can be narrower
+    values = []
+    for start in range(0, rx.shape[1], nwin):
+        energy = rx[:, start : start + nwin].ravel() ** 2
+        total = np.sum(energy)
+        if total == 0:
+            values.append(np.nan)
+        elif metric == "entropy":
+            # Shannon entropy of normalized energy
+            p = energy[energy > 0] / total
+            values.append(-np.sum(p * np.log(p)))
+        else:
+            # Normalized fourth moment
+            values.append(energy.size * np.sum(energy**2) / total**2)
+
+    return np.array(values)
+
+
+def check_options(window, precision, max_memory, kernel, taps, workers):
+    # Validate migration options, returns precision, taps and workers with defaults
+    # filled in
+    if precision is None:
+        single = ghog.config.float_type() == np.float32
+        precision = "single" if single else "double"
+
+    if window not in WINDOWS:
+        raise ValueError(
+            "Invalid window argument: %s. window must be one of: %s" % (window, WINDOWS)
+        )
+
+    if precision not in PRECISION:
+        raise ValueError(
+            "Invalid precision argument: %s. precision must be one of: %s"
+            % (precision, list(PRECISION))
+        )
+
+    if max_memory is not None and max_memory <= 0:
+        raise ValueError("max_memory must be positive.")
+
+    if kernel not in KERNELS:
+        raise ValueError(
+            "Invalid kernel argument: %s. kernel must be one of: %s"
+            % (kernel, list(KERNELS))
+        )
+
+    if taps is None:
+        taps = KERNELS[kernel]
+
+    if taps < 2 or taps % 2 != 0:
+        raise ValueError("taps must be an even number of at least two.")
+
+    return precision, taps, ghog.config.thread_count(workers)
+
+
+def migrate_image(
+    rx,
+    ttaper,
+    xtaper,
+    mt,
+    mx,
+    dt,
+    dx,
+    cmig,
+    precision,
+    kernel,
+    taps,
+    workers,
+    out=None,
+    spare=None,
+):
+    # Migrate one image, padded to mt x mx, into out or a new array. A remap table is
+    # only built for the cache if it fits in spare bytes.
+    nt = rx.shape[0]
+    nx = rx.shape[1]
+
+    RX = spectrum(rx, ttaper, xtaper, mt, mx, precision, workers)
+    RXmig = migrate(RX, mt, dt, dx, cmig, kernel, taps, workers, spare)
+    del RX
+
+    return inverse(RXmig, mt, nt, nx, workers, out)
+
+
+def inverse(RXmig, mt, nt, nx, workers=1, out=None):
+    # Image of a transposed migrated spectrum, trimmed to nt x nx, into out or a new
+    # array. The spectrum is overwritten.
+
+    # Inverse 2D fft, distance then time
+    RXmig = scipy.fft.ifft(RXmig, axis=0, overwrite_x=True, workers=workers)
+    rxmig = scipy.fft.irfft(RXmig, n=mt, axis=1, workers=workers)
+    del RXmig
+
+    # Trim to original dimension, copied so the padded image is freed
+    if out is not None:
+        out[...] = rxmig[:nx, :nt].T
+        return out
+
+    return np.ascontiguousarray(rxmig[:nx, :nt].T)
+
 
-    # Calculate dz and kz values
+def spectrum(rx, ttaper, xtaper, mt, mx, precision="double", workers=1):
+    # Tapered, zero padded 2D spectrum of an image. Transposed, one row per distance
+    # wavenumber, so each row can be interpolated contiguously. Real input so only
+    # non-negative frequencies are kept.
+    nt = rx.shape[0]
+    nx = rx.shape[1]
+    rdtype, cdtype = PRECISION[precision]
+
+    ## Taper and pad
+    # The taper is separable, applied one axis at a time into the padded buffer
+    rxpad = np.zeros((mx, mt), dtype=rdtype)
+    np.multiply(rx.T, xtaper[:, np.newaxis], out=rxpad[:nx, :nt])
+    rxpad[:nx, :nt] *= ttaper[np.newaxis, :]
+
+    # 2D fft, time then distance
+    RX = scipy.fft.rfft(rxpad, axis=1, workers=workers)
+    del rxpad
+    return scipy.fft.fft(RX, axis=0, overwrite_x=True, workers=workers)
+
+
+def migrate(RX, mt, dt, dx, cmig, kernel="linear", taps=2, workers=1, spare=None):
+    # Map a transposed spectrum from frequency to vertical wavenumber, all distance
+    # wavenumbers at once in blocks of rows. Blocks are spread over threads for large
+    # spectra, numpy releases the GIL for the gathers and arithmetic.
+    mx, nw = RX.shape
+    rdtype = RX.real.dtype
+
+    # Remap table from the cache, or filled in as blocks are migrated and then cached if
+    # it fits in the cache and in spare bytes. Otherwise each block's table is built
+    # as it's migrated and dropped.
+    key = (mt, mx, dt, dx, cmig, np.dtype(rdtype).str)
+    table = lookup_table(key)
+    nbytes = table_memory(mt, mx, rdtype)
+    fill = (
+        table is None
+        and nbytes <= ghog.config.stolt_cache_bytes
+        and (spare is None or nbytes <= spare)
+    )
+    if fill:
+        table = (
+            np.empty((mx, nw), dtype=np.int32),
+            np.empty((mx, nw), dtype=rdtype),
+            np.empty((mx, nw), dtype=rdtype),
+        )
+
+    RXmig = np.empty_like(RX)
+    nrow = max(1, BLOCK_SAMPLES // nw)
+    blocks = [slice(i, i + nrow) for i in range(0, mx, nrow)]
+
+    def run(rows):
+        if table is None:
+            j, f, obliq = remap_table(mt, mx, dt, dx, cmig, rdtype, rows)
+        else:
+            if fill:
+                block = remap_table(mt, mx, dt, dx, cmig, rdtype, rows)
+                for t, b in zip(table, block):
+                    t[rows] = b
+            j, f, obliq = (t[rows] for t in table)
+        RXmig[rows] = migrate_rows(RX[rows], j, f, obliq, kernel, taps)
+
+    if workers > 1 and len(blocks) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(run, blocks))
+    else:
+        for rows in blocks:
+            run(rows)
+
+    if fill:
+        store_table(key, table)
+
+    return RXmig
+
+
+def remap_table(mt, mx, dt, dx, cmig, rdtype, rows=slice(None)):
+    # Remap table of rows of a transposed mt x mx spectrum. For each distance and
+    # vertical wavenumber, the index of the frequency below, the fraction of a sample
+    # past it, and the obliquity factor. Frequencies past the end are clamped to the
+    # last one.
+    kx = scipy.fft.fftfreq(mx, d=dx)[rows]
+
+    # Calculate dz and kz values, the migrated spectrum is Hermitian so only
+    # non-negative kz are needed. Frequencies are uniform, so the fractional index of
+    # a frequency is just a division.
     dz = dt * cmig / 2
-    kz = np.fft.fftshift(np.fft.fftfreq(rx.shape[0], d=dz))
+    kz = scipy.fft.rfftfreq(mt, d=dz)
+    dw = 1.0 / (mt * dt)
+    nw = len(kz)
 
-    # Interpolate each column to new w corresponding to kz
-    RXmig = np.zeros_like(RX)
-    for i in range(RX.shape[1]):
-        wkz = np.sign(kz) * (cmig / 2) * np.sqrt(kx[i] ** 2 + kz**2)
-        RXmig[:, i] = np.interp(wkz, w, RX[:, i])
-        with np.errstate(divide="ignore", invalid="ignore"):
-            RXmig[:, i] = RXmig[:, i] * np.abs(
-                kz / np.sqrt(kx[i] ** 2 + kz**2)
-            )  # obliquity
+    k = np.sqrt(kx[:, np.newaxis] ** 2 + kz[np.newaxis, :] ** 2)
+    p = k * ((cmig / 2) / dw)
+    j = p.astype(np.int32)
+    f = (p - j).astype(rdtype)
+    f[j >= nw - 1] = 0
+    np.minimum(j, nw - 1, out=j)
 
-    RXmig[np.isnan(RXmig)] = 0  # for (kx=0, kz=0)
+    # Obliquity, zero at (kx=0, kz=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.divide(kz[np.newaxis, :], k, out=k)
+    k[~np.isfinite(k)] = 0
 
-    # Inverse 2D fft
-    RXmig = np.fft.fftshift(RXmig)
-    rxmig = np.real(np.fft.ifft2(RXmig))
+    return j, f, k.astype(rdtype, copy=False)
 
-    # Trim to original dimension
-    rxmig = rxmig[:nt, :nx]
 
-    attrs["vmig"] = cmig
+def lookup_table(key):
+    # Cached remap table of a grid, None if it isn't cached. Misses are only counted
+    # while the cache is on.
+    with tables_lock:
+        if key in tables:
+            tables.move_to_end(key)
+            cache_stats["hits"] += 1
+            return tables[key]
+        if ghog.config.stolt_cache_bytes > 0:
+            cache_stats["misses"] += 1
+        return None
+
+
+def store_table(key, table):
+    # Cache a remap table, dropping the least recently used to stay within
+    # ghog.config.stolt_cache_bytes
+    limit = ghog.config.stolt_cache_bytes
+    with tables_lock:
+        tables[key] = table
+        while sum(sum(a.nbytes for a in t) for t in tables.values()) > limit:
+            tables.popitem(last=False)
+
+
+def table_memory(mt, mx, rdtype):
+    # Bytes of the remap table of a padded grid, an index and two real arrays the size
+    # of the half spectrum
+    return mx * (mt // 2 + 1) * (4 + 2 * np.dtype(rdtype).itemsize)
+
+
+def spare_memory(mt, mx, precision, max_memory=None):
+    # Memory budget left over after migrating a padded image, None if there's no budget
+    if max_memory is None:
+        return None
+
+    return max_memory - stolt_memory(mt, mx, precision)
+
+
+def stolt_cache_info():
+    """Get remap table cache statistics.
+
+    Stolt migration can keep the tables mapping frequency to vertical wavenumber of
+    recently migrated grids, by padded shape, sample interval, trace interval, migration
+    velocity and precision, so files migrated alike skip building them. Tables take
+    more memory than the spectrum, so the cache is off unless
+    ghog.config.stolt_cache_bytes is set to the bytes it may hold. A table is only
+    cached if it also fits a migration's max_memory.
+
+    Returns:
+        Dictionary of cache hits, misses, tables held (size), and bytes held.
+    """
+    with tables_lock:
+        return {
+            "hits": cache_stats["hits"],
+            "misses": cache_stats["misses"],
+            "size": len(tables),
+            "bytes": sum(sum(a.nbytes for a in t) for t in tables.values()),
+        }
+
+
+def stolt_cache_clear():
+    """Empty the remap table cache and reset its statistics."""
+    with tables_lock:
+        tables.clear()
+        cache_stats["hits"] = 0
+        cache_stats["misses"] = 0
+
+
+def migrate_rows(RX, j, f, obliq, kernel="linear", taps=2):
+    # Interpolate rows of a transposed spectrum with their remap table and apply the
+    # obliquity factor
+    nrow, nw = RX.shape
+
+    # Flat indices of each row's samples
+    first = (np.arange(nrow) * nw)[:, np.newaxis]
+    last = first + (nw - 1)
+    j = j + first
+    flat = RX.reshape(-1)
+
+    if kernel == "linear":
+        out = np.take(flat, np.minimum(j + 1, last))
+        a = np.take(flat, j)
+        out -= a
+        out *= f
+        out += a
+    else:
+        offsets = np.arange(1 - taps // 2, taps // 2 + 1)
+        out = np.zeros((nrow, nw), dtype=RX.dtype)
+        for m, weight in zip(offsets, kernel_weights(f, offsets, kernel)):
+            out += weight * np.take(flat, np.clip(j + m, first, last))
+
+    out *= obliq
+
+    return out
 
-    return {"rx": rxmig, "gps": np.copy(data["gps"]), "attrs": attrs}
+
+def kernel_weights(f, offsets, kernel):
+    # Interpolation weights of samples at offsets from the sample below fractional
+    # positions f. Lagrange polynomial through the samples, or a Lanczos windowed sinc
+    # normalized to sum to one.
+    if kernel == "lagrange":
+        weights = []
+        for m in offsets:
+            weight = np.ones_like(f)
+            for q in offsets:
+                if q != m:
+                    weight *= (f - q) / (m - q)
+            weights.append(weight)
+        return weights
+
+    half = len(offsets) // 2
+    weights = [np.sinc(f - m) * np.sinc((f - m) / half) for m in offsets]
+    total = sum(weights)
+    return [weight / total for weight in weights]
+
+
+def aperture(nt, dt, dx, cmig):
+    # Half width in traces of the widest diffraction hyperbola within the record, its
+    # apex at the surface and tails at the record depth
+    return int(np.ceil(nt * dt * cmig / 2 / dx))
+
+
+def tile_starts(nx, tile, overlap):
+    # First trace of each window, stepping by tile - overlap, the last window ending at
+    # the last trace
+    starts = list(range(0, nx - tile, tile - overlap))
+    return starts + [nx - tile]
+
+
+def blend(tile, overlap, left, right):
+    # Overlap-add weight of a window, ramping up from its left and down to its right
+    # edge if there are neighbouring windows. Positive everywhere, normalized after
+    # summing since the last window can overlap more.
+    w = np.ones(tile)
+    ramp = np.sin(np.pi / 2 * (np.arange(overlap) + 0.5) / overlap) ** 2
+    if left and overlap > 0:
+        w[:overlap] = ramp
+    if right and overlap > 0:
+        w[tile - overlap :] = ramp[::-1]
+    return w
+
+
+def stolt_memory(mt, mx, precision="double"):
+    """Approximate peak memory of migrating a padded image.
+
+    Args:
+        mt: Padded length of time axis.
+        mx: Padded length of distance axis.
+        precision: Floating point precision, valid options are ["double", "single"]
+            (default = "double").
+
+    Returns:
+        Bytes.
+    """
+    rdtype, cdtype = PRECISION[precision]
+
+    # Two half spectra, or a half spectrum and a padded image, are live at once
+    return 2 * np.dtype(cdtype).itemsize * (mt // 2 + 1) * mx
+
+
+def padded_shape(nt, nx, pt, px, precision="double", max_memory=None):
+    # Padded image shape, at least the zero padding asked for and rounded up to fast FFT
+    # lengths. Default padding is reduced to fit the memory budget, time axis first.
+    ptmax = 10 * nt if pt is None else pt
+    pxmax = 1 * nx if px is None else px
+
+    mx = scipy.fft.next_fast_len(nx + pxmax)
+    mt = scipy.fft.next_fast_len(nt + ptmax, real=True)
+
+    if max_memory is None or stolt_memory(mt, mx, precision) <= max_memory:
+        return mt, mx
+
+    for mx in [mx, scipy.fft.next_fast_len(nx)] if px is None else [mx]:
+        if pt is None:
+            mt = fit_len(nt, nt + ptmax, mx, precision, max_memory)
+
+        if mt is not None and stolt_memory(mt, mx, precision) <= max_memory:
+            return mt, mx
+
+    raise ValueError(
+        "max_memory of %d bytes is too small to migrate a %d x %d image."
+        % (max_memory, nt, nx)
+    )
+
+
+def fit_len(nmin, nmax, mx, precision, max_memory):
+    # Longest time axis length between nmin and nmax within the memory budget,
+    # preferring fast FFT lengths, None if there isn't one
+    rdtype, cdtype = PRECISION[precision]
+    nfit = min(2 * int(max_memory // (2 * np.dtype(cdtype).itemsize * mx)) - 1, nmax)
+
+    for n in range(nfit, nmin - 1, -1):
+        if scipy.fft.next_fast_len(n, real=True) == n:
+            return n
+
+    return nmin if nfit >= nmin else None
+
+
+def taper(n, ntaper, window="box"):
+    """Taper for one axis of an image.
+
+    Args:
+        n: Length of the axis.
+        ntaper: Taper width in pixels.
+        window: Taper window shape, valid options are ["box", "hann", "tukey"]
+            (default = "box").
+
+    Returns:
+        Taper weights, between 0 and 1.
+    """
+    if window == "box":
+        # Edge mask smoothed with a box
+        w = np.ones(n)
+        w[: ntaper // 2] = 0
+        w[-ntaper // 2 :] = 0
+        return scipy.signal.convolve(w, np.ones(ntaper) / ntaper, mode="same")
+    elif window == "hann":
+        return scipy.signal.windows.hann(n)
+    elif window == "tukey":
+        return scipy.signal.windows.tukey(n, alpha=min(1, 2 * ntaper / n))
+
+    raise ValueError(
+        "Invalid window argument: %s. window must be one of: %s" % (window, WINDOWS)
+    )
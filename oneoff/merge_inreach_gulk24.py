@@ -8,6 +8,8 @@ import os
 #import matplotlib as mpl
 #mpl.rcParams['axes.formatter.useoffset'] = False
 
+import ghog.gps
+
 
 def cli():
     # Command line interface
@@ -45,7 +47,8 @@ def main():
         with h5py.File(h5, mode="r+") as fd:
             skip = False
             try:
-                h5times = np.array(list(map(np.datetime64, fd["raw/gps0"]["utc"])))
+                gps = fd["raw/gps0"][:]
+                h5times = ghog.gps.gps_times(gps)
             except KeyError:
                 print(h5, "has no /raw/gps0")
                 continue
@@ -71,20 +74,9 @@ def main():
             #plt.title(os.path.basename(h5))
             #plt.show()
 
-            ppp_t = np.dtype(
-                [("lon", "f8"), ("lat", "f8"), ("hgt", "f8"), ("utc", "S26")]
+            ppp = ghog.gps.gps_array(
+                loni, lati, hgti, h5times, epoch="epoch" in gps.dtype.names
             )
-            ppp = [None] * len(h5times)
-            for i in range(len(h5times)):
-                ppp[i] = tuple(
-                    [
-                        loni[i],
-                        lati[i],
-                        hgti[i],
-                        h5times[i],
-                    ]
-                )
-            ppp = np.array(ppp, dtype=ppp_t)
 
             raw = fd.require_group("raw")
             ppp0 = raw.require_dataset(